@@ -22,11 +22,38 @@ import dns.resolver
 import dns.message
 import dns.rdtypes.IN.A
 import dns.rdatatype
+import dns.rdataclass
+import dns.rcode
+import dns.flags
+import dns.rrset
+import dns.query
+import dns.opcode
 import SocketServer
 from SocketServer import ThreadingMixIn, UDPServer
 import socket
 import logging
 import imp
+import signal
+import threading
+import select
+import errno
+import asyncore
+import heapq
+import struct
+import random
+import Queue
+import BaseHTTPServer
+import collections
+import copy
+
+# TTL on answers for static hosts
+STATIC_TTL = 5
+
+# names simple enough for `DNSProtocol.answer_static` to handle
+SIMPLE_NAME = re.compile(r'[A-Za-z0-9_*-]+(\.[A-Za-z0-9_*-]+)*\Z')
+
+# python 2 doesn't know about SO_REUSEPORT; this is its value on linux
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
 
 logging.basicConfig(
     format='[%(asctime)s] %(levelname)-10s %(message)s', 
@@ -39,97 +66,1850 @@ class DNSProtocol(object):
     Knows how to respond to DNS messages, but mostly by just shipping them off 
     to some real nameserver. The main entry point is `DNSProtocol.handle(data)`.
     """
-    def __init__(self, config):
+    # how long a client waits for upstream before getting a stale answer, if
+    # there is one (RFC 8767's client response timer)
+    stale_timeout = 1.8
+
+    def __init__(self, config, cache=None, upstreams=None, pool=None, max_size=512,
+                 flights=None, metrics=None, querylog=None):
         self.config = config
+        self.cache = cache
+        self.upstreams = upstreams or Upstreams()
+        self.pool = pool
+        self.max_size = max_size # None over TCP
+        # EDNS0 UDP payload size we advertise, to clients and upstreams alike
+        self.edns_payload = getattr(config, 'edns_payload', 1232)
+        self.flights = flights
+        self.metrics = metrics
+        self.querylog = querylog
+        # how the request was answered: static, cached, forwarded, coalesced,
+        # stale or failed
+        self.outcome = None
 
     def handle(self, data):
         """ Handle a dns message. """
-        with open('request.bin', 'wb') as fout:
-            fout.write(data)
+        wire = self.answer_static(data)
+        if wire is not None:
+            return wire
+        msg = self.parse(data)
+        wire, nameservers = self.answer_locally(msg)
+        if wire is None:
+            if self.cache is not None and self.cache.has_stale(msg):
+                wire = self.forward_or_stale(msg, nameservers)
+            else:
+                wire = self.forward_and_finish(msg, nameservers)
+        return wire
+
+    def forward_and_finish(self, msg, nameservers):
+        response, leader = self.forward_once(msg, nameservers)
+        return self.finish(msg, response, nameservers, store=leader)
+
+    def forward_or_stale(self, msg, nameservers):
+        """
+        `forward_and_finish` from a thread of its own, answering with the
+        stale answer instead if upstream hasn't come back within
+        `stale_timeout`. The forward carries on regardless, to refresh the
+        cache.
+        """
+        background = copy.copy(self)
+        result = []
+        done = threading.Event()
+        def forward():
+            try:
+                result.append(background.forward_and_finish(msg, nameservers))
+            except Exception:
+                log.exception('could not forward %s', msg.id)
+            finally:
+                done.set()
+        thread = threading.Thread(target=forward, name='forward-%d' % msg.id)
+        thread.daemon = True
+        thread.start()
+        if not done.wait(self.stale_timeout) or not result:
+            wire = self.stale_answer(msg)
+            if wire is not None:
+                return wire
+            done.wait()
+        if not result:
+            # the forward fell over, and the stale answer's gone since
+            return self.servfail(msg)
+        self.outcome = background.outcome
+        return result[0]
+
+    def answer_static(self, data):
+        """
+        Answer a plain `A` query for a static host straight from the wire:
+        the query's id and question with the answer record that was encoded
+        when the config was loaded, no message objects involved. Returns None
+        for anything that needs the full treatment.
+        """
+        if len(data) < 17:
+            return None
+        qid, flags, qdcount, ancount, nscount, arcount = struct.unpack('!6H', data[:12])
+        # QR and opcode must be 0, and it must be a lone question, maybe
+        # with an OPT record
+        if flags & 0xf800 or qdcount != 1 or ancount or nscount or arcount > 1:
+            return None
+        question = read_question(data)
+        if question is None:
+            return None
+        labels, rdtype, rdclass, end = question
+        if rdtype != dns.rdatatype.A or rdclass != dns.rdataclass.IN:
+            return None
+        opt = ''
+        if arcount:
+            # EDNS version 0 only; answer with our own OPT, as make_response would
+            if data[end:end + 1] != '\x00' or len(data) < end + 11:
+                return None
+            rdtype, payload, ednsflags, rdlen = struct.unpack('!HHIH', data[end + 1:end + 11])
+            if rdtype != dns.rdatatype.OPT or ednsflags & 0xff0000 or end + 11 + rdlen != len(data):
+                return None
+            opt = struct.pack('!BHHIH', 0, dns.rdatatype.OPT, self.edns_payload or 512, 0, 0)
+        elif end != len(data):
+            return None
+        name = '.'.join(labels)
+        if not SIMPLE_NAME.match(name) or name.count('.') != len(labels) - 1:
+            return None # leave escaping oddities to dnspython
+        rule = self.config.rules.lookup(name)
+        if rule is None or isinstance(rule[1], list):
+            return None
+        ipaddr = rule[1]
+        self.rule_hit(rule)
+        self.outcome = 'static'
+        self.log_query('%-10s%-8s%s. IN A', 'Question:', qid, name)
+        self.log_query('%-10s%-8s[\'%s. %d IN A %s\'] DNS: %s', 'Answer:', qid, name, STATIC_TTL, ipaddr, '[* STATIC IP *]')
+        # QR, plus RD copied from the query, same as dns.message.make_response
+        header = struct.pack('!6H', qid, 0x8000 | (flags & dns.flags.RD), 1, 1, 0, arcount)
+        return header + data[12:end] + self.config.rules.answers[ipaddr] + opt
+
+    def parse(self, data):
         msg = dns.message.from_wire(data)
         log.debug('[REQUEST]\n%s\n[/REQUEST]', str(msg))
+        return msg
+
+    def answer_locally(self, msg):
+        """
+        Answer `msg` from static config or the cache if we can. Returns a
+        tuple (wire, [nameservers]): `wire` is the response, or None if the
+        message needs to be sent on to [nameservers].
+        """
         nameservers = self.config.default
         if len(msg.question) > 1:
             log.warning("Warning: multi-question messages " +\
                     "are not yet supported. Using default nameserver.")
-            return self.forward_request(msg, nameservers).to_wire()
+            return None, nameservers
         question = msg.question[0]
-        log.info('%-10s%-8s%s', 'Question:', msg.id, str(question))
+        self.log_query('%-10s%-8s%s', 'Question:', msg.id, question)
         if question.rdtype == dns.rdatatype.A:
             name = question.name.to_text()
             ipaddr, nameservers = self.resolve_by_config(name)
             if ipaddr:
                 response = self.create_response(ipaddr, msg)
-                log.info('%-10s%-8s%s DNS: %s', 'Answer:', response.id, map(str, response.answer), '[* STATIC IP *]')
-                with open('response.bin', 'wb') as fout:
-                    fout.write(response.to_wire())
-                return response.to_wire()
+                self.log_query('%-10s%-8s%s DNS: %s', 'Answer:', response.id, LazyList(response.answer), '[* STATIC IP *]')
+                self.outcome = 'static'
+                return response.to_wire(), nameservers
+
+        # maybe we've seen this one recently
+        if self.cache is not None:
+            response = self.cache.get(msg)
+            if response is not None:
+                self.log_query('%-10s%-8s%s DNS: %s', 'Answer:', response.id, LazyList(response.answer), '[* CACHED *]')
+                self.outcome = 'cached'
+                return self.to_wire(msg, response), nameservers
+            # no point waiting on nameservers we know aren't answering
+            if self.upstreams.unreachable(nameservers, time.time()):
+                wire = self.stale_answer(msg)
+                if wire is not None:
+                    return wire, nameservers
+        return None, nameservers
 
-        # let some nameserver handle the message
-        response = self.forward_request(msg, nameservers)
+    def finish(self, msg, response, nameservers, store=True):
+        """
+        Wrap up a forwarded `msg`, given the `response` the nameservers came
+        back with (None if none of them did). Returns the wire data to send.
+        `store` is False for a response someone else already cached.
+        """
+        if response is None or response.rcode() == dns.rcode.SERVFAIL:
+            wire = self.stale_answer(msg)
+            if wire is not None:
+                return wire
+        if response is None:
+            log.warning('%-10s%-8sno answer from %r', 'Failed:', msg.id, nameservers)
+            return self.servfail(msg)
+        self.outcome = 'forwarded' if store else 'coalesced'
+        if store and self.cache is not None:
+            self.cache.put(msg, response)
         log.debug('[RESPONSE]\n%s\n[/RESPONSE]', str(response))
-        log.info('%-10s%-8s%s DNS: %r', 'Answer:', response.id, map(str, response.answer), nameservers)
+        self.log_query('%-10s%-8s%s DNS: %r', 'Answer:', response.id, LazyList(response.answer), nameservers)
+        return self.to_wire(msg, response)
+
+    def servfail(self, msg):
+        self.outcome = 'failed'
+        response = dns.message.make_response(msg, our_payload=self.edns_payload or 512)
+        response.set_rcode(dns.rcode.SERVFAIL)
         return response.to_wire()
 
+    def stale_answer(self, msg):
+        """ The expired answer to `msg` from the cache as wire data, or None """
+        stale = self.cache.get_stale(msg) if self.cache is not None else None
+        if stale is None:
+            return None
+        self.log_query('%-10s%-8s%s DNS: %s', 'Answer:', stale.id, LazyList(stale.answer), '[* STALE *]')
+        self.outcome = 'stale'
+        return self.to_wire(msg, stale)
+
+    def to_wire(self, msg, response):
+        """
+        `response` as wire data, or an empty truncated response if it's too
+        big for the client, who can come back over TCP for the rest. It has
+        an OPT record, advertising our payload size, only if `msg` did, and
+        can be as big as the smaller of the two payload sizes.
+        """
+        our_payload = self.edns_payload or 512
+        max_size = self.max_size
+        # a copy, so the upstream's response can still be cached and handed
+        # on as it came
+        response = copy.copy(response)
+        if msg.edns >= 0:
+            # options (cookies and the like) are per hop, so the upstream's stay behind
+            response.use_edns(0, response.ednsflags, our_payload)
+            if max_size is not None:
+                max_size = max(min(msg.payload, our_payload), max_size)
+        else:
+            response.use_edns(False)
+        # use_edns makes our payload the limit to_wire enforces, by raising
+        # TooBig; render it whole and decide about truncating ourselves
+        wire = response.to_wire(max_size=65535)
+        if max_size is not None and len(wire) > max_size:
+            response = dns.message.make_response(msg, our_payload=our_payload)
+            response.flags |= dns.flags.TC
+            wire = response.to_wire()
+        return wire
+
+    def upstream_message(self, msg):
+        """
+        `msg` as it should be forwarded: with EDNS0 advertising our payload
+        size, so that big answers don't need a retry over TCP, and the DO flag
+        if the client set it. The client's options are for us, not upstream.
+        """
+        if not self.edns_payload:
+            return msg
+        upstream = copy.copy(msg)
+        if msg.edns >= 0:
+            upstream.use_edns(0, msg.ednsflags & dns.flags.DO, self.edns_payload)
+        else:
+            upstream.use_edns(0, 0, self.edns_payload)
+        return upstream
+
+    def forward_once(self, msg, nameservers):
+        """
+        `forward_request`, unless the same question is already on its way
+        upstream, in which case wait for that answer instead. Returns a tuple
+        (response, leader) where `leader` is True if we did the asking.
+        """
+        if self.flights is None:
+            return self.forward_request(msg, nameservers), True
+        landed = threading.Event()
+        result = []
+        if not self.flights.join(msg, lambda response: (result.append(response), landed.set())):
+            landed.wait(self.flights.timeout)
+            return (result[0] if result else None), False
+        response = None
+        try:
+            response = self.forward_request(msg, nameservers)
+        finally:
+            self.flights.land(msg, response)
+        return response, True
 
     def forward_request(self, msg, nameservers):
-        for ns in nameservers:
-            try:
-                # xxx: when do we use tcp? (message size-based?)
-                response = dns.query.udp(msg, ns, timeout=10)
-                return response
-            except:
-                continue
-        # XXX: raise exception here, or return some sort of 
-        # error response to client
+        """ Send `msg` upstream and wait for the response, or None. """
+        query = UpstreamQuery(self.upstream_message(msg), nameservers, self.upstreams,
+                port=getattr(self.config, 'upstream_port', 53))
+        query.start(time.time())
+        while not query.done:
+            wait = max(query.next_event() - time.time(), 0)
+            # poll, since select can't take descriptors past 1024, and with a
+            # thread per query in flight there can easily be that many
+            poller = select.poll()
+            sockets = {}
+            for sock in query.sockets():
+                sockets[sock.fileno()] = sock
+                poller.register(sock, select.POLLIN)
+            events = poller.poll(wait * 1000)
+            now = time.time()
+            for fd, event in events:
+                if query.done:
+                    break
+                query.on_readable(sockets[fd], now)
+            query.poll(now)
+        response = query.response
+        if response is not None and response.flags & dns.flags.TC and self.pool is not None:
+            if self.metrics is not None:
+                self.metrics.count('tcp_retries')
+            response = self.pool.query(query.msg, query.nameserver, query.port) or response
+        return response
+
+    def nameservers_for(self, msg):
+        """ Where a forwarded `msg` should go """
+        question = msg.question[0]
+        if question.rdtype == dns.rdatatype.A:
+            return self.resolve_by_config(question.name.to_text())[1]
+        return self.config.default
+
+    def refresh(self, msg):
+        """ Fetch `msg` from upstream again just to update the cache """
+        nameservers = self.nameservers_for(msg)
+        response, leader = self.forward_once(msg, nameservers)
+        if leader and response is not None:
+            self.finish(msg, response, nameservers)
 
     def resolve_by_config(self, name):
         """ 
-        Look through `config` dictionary for either an IP address or a 
+        Look through `config` rules for either an IP address or a 
         nameserver to use to resolve a `name`. Returns 
         a tuple (ipaddr, [nameservers]) in which the `ipaddr` can be None
         but [nameservers] will always be non-empty.
         """
-        # remove trailing '.' from name, if present.
-        if name[-1] is '.':
-            name = name[:-1]
-
         nameservers = self.config.default
         ipaddr = None
-        for key, item in self.config.hosts.iteritems():
-            # TODO: hosts really should be ordered so that you can effectively override.
-            if (key == name) or (hasattr(key, 'search') and key.search(name)):
-                if isinstance(item, list):
-                    nameservers = item
-                else:
-                    ipaddr = item
-                break
+        rule = self.config.rules.lookup(name)
+        if rule is not None:
+            self.rule_hit(rule)
+            key, item = rule
+            if isinstance(item, list):
+                nameservers = item
+            else:
+                ipaddr = item
         return ipaddr, nameservers
 
+    def log_query(self, format, *args):
+        """ Log a line about a query, to the `QueryLog` if there is one """
+        if self.querylog is not None:
+            self.querylog.write(format, args)
+        else:
+            log.info(format, *args)
+
+    def rule_hit(self, rule):
+        if self.metrics is not None:
+            key = rule[0]
+            self.metrics.count('rule_hits', ('rule', getattr(key, 'pattern', key)))
+
     def create_response(self, ipaddr, msg):
         """ 
         Create a response for an `A` message with an answer of `ipaddr` 
         """
-        response = dns.message.make_response(msg)
+        response = dns.message.make_response(msg, our_payload=self.edns_payload or 512)
         rrset = dns.rrset.RRset(msg.question[0].name, 1, 1)
-        rrset.ttl = 5
+        rrset.ttl = STATIC_TTL
         rrset.add(dns.rdtypes.IN.A.A(1, 1, ipaddr))
         response.answer.append(rrset)
         return response
 
+class UpstreamStats(object):
+    """ What we know about how one upstream nameserver has been behaving """
+    def __init__(self, srtt):
+        self.srtt = srtt
+        self.rttvar = srtt / 2
+        self.failure_rate = 0.0
+        self.failures = 0       # in a row
+        self.open_until = 0     # circuit breaker: skip it until then
+        self.cooldown = 0
+
+class Upstreams(object):
+    """
+    Tracks a smoothed RTT and failure rate for each upstream nameserver (much
+    like TCP's RTO estimate), which decide the order nameservers are tried in
+    and how long to wait before hedging with the next one. After `max_failures`
+    failures in a row a nameserver's circuit opens and it's left out for
+    `cooldown` seconds (doubling each time it fails again, up to
+    `max_cooldown`), after which a single query is let through to probe it.
+    """
+    initial_rtt = 0.25
+    min_hedge = 0.02
+    max_hedge = 2.0
+    max_failures = 5
+    cooldown = 5
+    max_cooldown = 300
+
+    def __init__(self, metrics=None):
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.metrics = metrics
+
+    def get(self, ns):
+        stats = self.stats.get(ns)
+        if stats is None:
+            stats = self.stats.setdefault(ns, UpstreamStats(self.initial_rtt))
+        return stats
+
+    def order(self, nameservers, now):
+        """
+        `nameservers`, best first. Those with an open circuit are left out,
+        unless that would leave nothing to try.
+        """
+        with self.lock:
+            def score(ns):
+                stats = self.get(ns)
+                return stats.srtt / max(1 - stats.failure_rate, 0.1)
+            healthy = [ns for ns in nameservers if self.get(ns).open_until <= now]
+            for ns in healthy:
+                stats = self.get(ns)
+                if stats.open_until:
+                    # half open: this query is the probe, the rest wait for it
+                    stats.open_until = now + stats.cooldown
+            return sorted(healthy or nameservers, key=score)
+
+    def unreachable(self, nameservers, now):
+        """ Whether every one of `nameservers` has an open circuit """
+        with self.lock:
+            return all(self.get(ns).open_until > now for ns in nameservers)
+
+    def rto(self, ns):
+        """ How long `ns` should reasonably take to answer """
+        stats = self.get(ns)
+        return stats.srtt + 4 * stats.rttvar
+
+    def hedge_delay(self, ns):
+        """ How long to give `ns` before also asking the next nameserver """
+        return min(max(self.rto(ns), self.min_hedge), self.max_hedge)
+
+    def success(self, ns, rtt):
+        if self.metrics is not None:
+            self.metrics.observe('upstream_seconds', rtt, ('upstream', ns))
+        with self.lock:
+            stats = self.get(ns)
+            stats.rttvar = 0.75 * stats.rttvar + 0.25 * abs(stats.srtt - rtt)
+            stats.srtt = 0.875 * stats.srtt + 0.125 * rtt
+            stats.failure_rate *= 0.9
+            stats.failures = 0
+            if stats.open_until:
+                log.info('Upstream %s is back', ns)
+            stats.open_until = 0
+            stats.cooldown = 0
+
+    def failure(self, ns, now):
+        if self.metrics is not None:
+            self.metrics.count('upstream_failures', ('upstream', ns))
+        with self.lock:
+            stats = self.get(ns)
+            stats.failure_rate = 0.9 * stats.failure_rate + 0.1
+            stats.failures += 1
+            if stats.failures >= self.max_failures:
+                if stats.cooldown:
+                    stats.cooldown = min(stats.cooldown * 2, self.max_cooldown)
+                else:
+                    stats.cooldown = self.cooldown
+                    log.warning('Upstream %s is not answering, leaving it out for a while', ns)
+                stats.open_until = now + stats.cooldown
+
+class UpstreamQuery(object):
+    """
+    A query forwarded over non-blocking UDP. It goes to the best of
+    `nameservers` first, and if that hasn't answered after its hedge delay,
+    to the next one as well, and so on; the first answer wins. It never waits
+    by itself: whoever drives it watches `sockets()`, calls `on_readable()`
+    when one of them has data and `poll()` by `next_event()` so that hedges
+    and timeouts fire. Once `done` is set, `response` is the answer, or None
+    if no nameserver gave one within `timeout`.
+    """
+    def __init__(self, msg, nameservers, upstreams, timeout=10, port=53):
+        self.msg = msg
+        self.wire = msg.to_wire()
+        self.nameservers = nameservers
+        self.upstreams = upstreams
+        self.timeout = timeout
+        self.port = port
+        self.pending = []
+        self.attempts = {}  # socket -> (nameserver, time sent)
+        self.next_send = None
+        self.deadline = None
+        self.response = None
+        self.nameserver = None  # the one that answered
+        self.done = False
+
+    def start(self, now):
+        self.pending = self.upstreams.order(self.nameservers, now)
+        self.deadline = now + self.timeout
+        self.send_next(now)
+
+    def sockets(self):
+        return self.attempts.keys()
+
+    def next_event(self):
+        if self.next_send is None:
+            return self.deadline
+        return min(self.next_send, self.deadline)
+
+    def send_next(self, now):
+        while self.pending:
+            ns = self.pending.pop(0)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(0)
+            try:
+                sock.connect((ns, self.port))
+                sock.send(self.wire)
+            except socket.error as e:
+                log.warning('could not send to %s: %s', ns, e)
+                sock.close()
+                self.upstreams.failure(ns, now)
+                continue
+            self.attempts[sock] = (ns, now)
+            self.next_send = now + self.upstreams.hedge_delay(ns)
+            return
+        self.next_send = None
+        if not self.attempts:
+            self.finish(now)
+
+    def on_readable(self, sock, now):
+        ns, sent = self.attempts[sock]
+        try:
+            data = sock.recv(65535)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            # most likely an ICMP port unreachable, so don't wait around
+            del self.attempts[sock]
+            sock.close()
+            self.upstreams.failure(ns, now)
+            self.send_next(now)
+            return
+        try:
+            response = dns.message.from_wire(data)
+        except Exception:
+            return
+        if not self.msg.is_response(response):
+            return
+        self.upstreams.success(ns, now - sent)
+        self.response = response
+        self.nameserver = ns
+        self.finish(now)
+
+    def poll(self, now):
+        if self.done:
+            return
+        if now >= self.deadline:
+            self.finish(now)
+        elif self.next_send is not None and now >= self.next_send:
+            self.send_next(now)
+
+    def finish(self, now):
+        # nameservers that lost the race only count as failing if they've
+        # had longer than they should need
+        for ns, sent in self.attempts.values():
+            if now - sent > self.upstreams.rto(ns):
+                self.upstreams.failure(ns, now)
+        self.close()
+        self.next_send = None
+        self.done = True
+
+    def close(self):
+        for sock in self.attempts:
+            sock.close()
+        self.attempts = {}
+
+class TCPConnection(object):
+    """
+    A persistent TCP connection to an upstream nameserver. Queries are
+    pipelined down it as they come, each under an id of our own (clients'
+    ids can collide), and a reader thread matches responses back to them in
+    whatever order they arrive. The connection closes itself after
+    `idle_timeout` seconds of quiet, or when the nameserver hangs up, and
+    anything still waiting is told None.
+    """
+    def __init__(self, ns, port=53, timeout=10, idle_timeout=30):
+        self.ns = ns
+        self.sock = socket.create_connection((ns, port), timeout)
+        self.sock.settimeout(idle_timeout)
+        self.pending = {}  # our id -> (msg, callback)
+        self.next_id = random.randrange(0x10000)
+        self.lock = threading.Lock()
+        self.closed = False
+        reader = threading.Thread(target=self.read_responses, name='tcp-%s' % ns)
+        reader.daemon = True
+        reader.start()
+
+    def submit(self, msg, callback):
+        """
+        Send `msg`, to have `callback(response)` called from the reader thread
+        later on. Returns the id it was sent under, or None if the connection
+        has closed.
+        """
+        wire = msg.to_wire()
+        with self.lock:
+            if self.closed or len(self.pending) >= 0xffff:
+                return None
+            while self.next_id in self.pending:
+                self.next_id = (self.next_id + 1) & 0xffff
+            qid = self.next_id
+            self.next_id = (self.next_id + 1) & 0xffff
+            self.pending[qid] = (msg, callback)
+            try:
+                self.sock.sendall(struct.pack('!HH', len(wire), qid) + wire[2:])
+            except socket.error:
+                del self.pending[qid]
+                return None
+        return qid
+
+    def cancel(self, qid):
+        with self.lock:
+            self.pending.pop(qid, None)
+
+    def read_responses(self):
+        try:
+            while True:
+                length, = struct.unpack('!H', self.recv_exactly(2))
+                data = self.recv_exactly(length)
+                qid, = struct.unpack('!H', data[:2])
+                with self.lock:
+                    msg, callback = self.pending.pop(qid, (None, None))
+                if msg is None:
+                    continue
+                try:
+                    response = dns.message.from_wire(struct.pack('!H', msg.id) + data[2:])
+                except Exception:
+                    log.warning('bad response over tcp from %s', self.ns)
+                    response = None
+                callback(response)
+        except (socket.error, EOFError):
+            pass
+        finally:
+            self.close()
+
+    def recv_exactly(self, size):
+        data = ''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending, self.pending = self.pending, {}
+        self.sock.close()
+        for msg, callback in pending.values():
+            callback(None)
+
+class TCPPool(object):
+    """
+    One persistent `TCPConnection` per upstream nameserver (and port), opened when it's
+    first needed and replaced whenever it closes. `query()` blocks;
+    `defer()` does the same from one of a few worker threads and calls back
+    with the result, for callers that can't wait.
+    """
+    workers = 8
+
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+        self.connections = {}
+        self.connecting = {}  # (ns, port) -> lock held while connecting to it
+        self.lock = threading.Lock()
+        self.queue = None
+
+    def connection(self, ns, port):
+        key = (ns, port)
+        with self.lock:
+            conn = self.connections.get(key)
+            if conn is not None and not conn.closed:
+                return conn
+            connecting = self.connecting.setdefault(key, threading.Lock())
+        # connecting can take a while; only hold up others wanting the same nameserver
+        with connecting:
+            with self.lock:
+                conn = self.connections.get(key)
+            if conn is None or conn.closed:
+                conn = TCPConnection(ns, port, self.timeout)
+                with self.lock:
+                    self.connections[key] = conn
+            return conn
+
+    def query(self, msg, ns, port=53):
+        """ The response to `msg` from `ns` over TCP, or None """
+        # if the connection turns out to have been closed under us, try once
+        # more on a fresh one
+        for attempt in range(2):
+            try:
+                conn = self.connection(ns, port)
+            except socket.error as e:
+                log.warning('could not connect to %s over tcp: %s', ns, e)
+                return None
+            answered = threading.Event()
+            result = []
+            qid = conn.submit(msg, lambda response: (result.append(response), answered.set()))
+            if qid is None:
+                continue
+            answered.wait(self.timeout)
+            if not result:
+                conn.cancel(qid)
+                return None
+            if result[0] is not None:
+                return result[0]
+        return None
+
+    def defer(self, msg, ns, callback, port=53):
+        with self.lock:
+            if self.queue is None:
+                self.queue = Queue.Queue()
+                for i in range(self.workers):
+                    worker = threading.Thread(target=self.work, name='tcp-worker-%d' % i)
+                    worker.daemon = True
+                    worker.start()
+        self.queue.put((msg, ns, port, callback))
+
+    def work(self):
+        while True:
+            msg, ns, port, callback = self.queue.get()
+            try:
+                callback(self.query(msg, ns, port))
+            except Exception:
+                log.exception('tcp query to %s failed', ns)
+
+def read_question(data):
+    """
+    Pick the first question out of a message's wire `data` without parsing
+    the rest. Returns a tuple ([labels], rdtype, rdclass, end offset), or None
+    if it's malformed or its name is compressed.
+    """
+    labels = []
+    offset = 12
+    try:
+        while True:
+            length = ord(data[offset])
+            offset += 1
+            if not length:
+                break
+            if length > 63:
+                return None # compression pointer
+            labels.append(data[offset:offset + length])
+            offset += length
+        rdtype, rdclass = struct.unpack('!HH', data[offset:offset + 4])
+    except (IndexError, struct.error):
+        return None
+    return labels, rdtype, rdclass, offset + 4
+
+class PacketCapture(object):
+    """
+    Keeps the last `size` packets to and from clients in memory, to be
+    written out as a pcap file on demand (SIGUSR1, or `dump()`); nothing
+    touches the disk until then. Only a `sample` fraction of queries is kept,
+    optionally just those whose name matches the `names` regex or that come
+    from one of `clients`. Responses are kept along with their queries.
+    """
+    def __init__(self, size=10000, sample=1.0, names=None, clients=None,
+                 path='bdns-%(pid)d.pcap'):
+        self.packets = collections.deque(maxlen=size)
+        self.sample = sample
+        self.names = re.compile(names, re.I) if names else None
+        self.clients = set(clients or [])
+        self.path = path
+
+    def record_query(self, client, server, data):
+        """
+        Record the query `data` from `client` to `server` if we're interested
+        in it. Returns a function to call with the response wire data, or None.
+        """
+        if self.clients and client[0] not in self.clients:
+            return None
+        if self.sample < 1 and random.random() >= self.sample:
+            return None
+        if self.names is not None:
+            question = read_question(data)
+            if question is None or not self.names.search('.'.join(question[0])):
+                return None
+        self.packets.append((time.time(), client, server, data))
+        return lambda wire: self.packets.append((time.time(), server, client, wire))
+
+    def dump(self, path=None):
+        """ Write what we have to a pcap file, as UDP over raw IPv4 """
+        path = (path or self.path) % {'pid': os.getpid()}
+        packets = list(self.packets)
+        with open(path, 'wb') as fout:
+            # version 2.4, snaplen 65535, LINKTYPE_RAW
+            fout.write(struct.pack('=IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 101))
+            for when, src, dst, data in packets:
+                udp = struct.pack('!HHHH', src[1], dst[1], 8 + len(data), 0) + data
+                ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(udp), 0, 0x4000, 64,
+                        socket.IPPROTO_UDP, 0, socket.inet_aton(src[0]), socket.inet_aton(dst[0]))
+                ip = ip[:10] + struct.pack('!H', ip_checksum(ip)) + ip[12:]
+                fout.write(struct.pack('=IIII', int(when), int(when % 1 * 1000000), len(ip) + len(udp), len(ip) + len(udp)))
+                fout.write(ip + udp)
+        log.info('Wrote %d packets to %s', len(packets), path)
+        return path
+
+    def dump_soon(self):
+        """ `dump()` from a thread of its own, for signal handlers """
+        thread = threading.Thread(target=self.dump, name='capture-dump')
+        thread.daemon = True
+        thread.start()
+
+def ip_checksum(header):
+    total = sum(struct.unpack('!%dH' % (len(header) / 2), header))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+def answer_record(ipaddr):
+    """
+    The wire form of an `A` answer record for `ipaddr`, with its owner name
+    compressed to a pointer at the question (which always starts at byte 12)
+    so that it fits any response to a single-question message.
+    """
+    return struct.pack('!HHHIH', 0xc00c, dns.rdatatype.A, dns.rdataclass.IN,
+            STATIC_TTL, 4) + socket.inet_aton(ipaddr)
+
+def host_items(hosts):
+    """ (key, value) pairs from a `hosts` dict or list of pairs """
+    if hasattr(hosts, 'items'):
+        return hosts.items()
+    return list(hosts)
+
+class HostIndex(object):
+    """
+    The `hosts` rules from bdns_settings, compiled once so that a lookup costs
+    about the same however many rules there are. Precedence is explicit:
+
+      1. exact names ('www.example.com')
+      2. wildcard domains ('*.example.com'), longest suffix first
+      3. regular expressions, in order
+
+    `hosts` may be a dict, in which case regexes are ordered by their pattern
+    text, or a list of (key, value) pairs to give the regex order yourself.
+    Regexes are folded into as few combined regexes as possible, with each
+    one's position in the alternation giving its precedence.
+    """
+    # python's re module can't handle more than 100 groups in one pattern
+    MAX_GROUPS = 90
+    UNCOMBINABLE = re.compile(r'\\[1-9]|\(\?P=|\(\?[aiLmsux]')
+
+    def __init__(self, hosts):
+        self.exact = {}
+        self.suffixes = {}
+        self.regexes = []
+        self.answers = {}  # static ip -> wire answer record, see `answer_record`
+        patterns = []
+        for key, value in host_items(hosts):
+            if not isinstance(value, list):
+                self.answers[value] = answer_record(value)
+            if hasattr(key, 'search'):
+                patterns.append((key, value))
+            elif key.startswith('*.'):
+                self.add_suffix(key[2:], (key, value))
+            else:
+                self.exact.setdefault(key.rstrip('.').lower(), (key, value))
+        if hasattr(hosts, 'items'):
+            patterns.sort(key=lambda rule: rule[0].pattern)
+        self.compile_patterns(patterns)
+
+    def add_suffix(self, domain, rule):
+        node = self.suffixes
+        for label in reversed(domain.rstrip('.').lower().split('.')):
+            node = node.setdefault(label, {})
+        node.setdefault(None, rule)
+
+    def compile_patterns(self, patterns):
+        """
+        Build `self.regexes`, a list of (match function, {group: rule},
+        combined). Runs of patterns that can safely share a regex (same flags,
+        no group names or backreferences of their own) are combined.
+        """
+        chunk, flags, groups = [], None, 0
+        for key, value in patterns:
+            if key.groupindex or self.UNCOMBINABLE.search(key.pattern):
+                self.flush_patterns(chunk, flags)
+                chunk, flags, groups = [], None, 0
+                self.regexes.append((key.search, {None: (key, value)}, False))
+                continue
+            if chunk and (key.flags != flags or groups + key.groups + 1 > self.MAX_GROUPS):
+                self.flush_patterns(chunk, flags)
+                chunk, groups = [], 0
+            chunk.append((key, value))
+            flags = key.flags
+            groups += key.groups + 1
+        self.flush_patterns(chunk, flags)
+
+    def flush_patterns(self, chunk, flags):
+        if not chunk:
+            return
+        # match() from the start, with each alternative free to skip ahead,
+        # means every position is tried for rule N before rule N+1 is looked at.
+        alternatives = []
+        rules = {}
+        for i, rule in enumerate(chunk):
+            group = 'r%d' % i
+            alternatives.append('(?:.*?(?P<%s>%s))' % (group, rule[0].pattern))
+            rules[group] = rule
+        regex = re.compile('|'.join(alternatives), flags | re.DOTALL)
+        self.regexes.append((regex.match, rules, True))
+
+    def lookup(self, name):
+        """ Return the (key, value) of the first rule that matches `name`, or None. """
+        name = name.rstrip('.')
+        lowered = name.lower()
+        rule = self.exact.get(lowered)
+        if rule is not None:
+            return rule
+
+        labels = lowered.split('.')
+        node = self.suffixes
+        for i in xrange(len(labels) - 1, 0, -1):
+            node = node.get(labels[i])
+            if node is None:
+                break
+            rule = node.get(None, rule)
+        if rule is not None:
+            return rule
+
+        for match, rules, combined in self.regexes:
+            m = match(name)
+            if m:
+                if combined:
+                    return rules[m.lastgroup]
+                return rules[None]
+        return None
+
+def response_ttl(response):
+    """
+    Work out how many seconds `response` may be cached for, or None if it
+    shouldn't be cached at all. Negative answers (NXDOMAIN / NODATA) use the
+    SOA negative TTL, as per RFC 2308.
+    """
+    if response.flags & dns.flags.TC:
+        return None
+    rcode = response.rcode()
+    if rcode == dns.rcode.NOERROR and response.answer:
+        return min(rrset.ttl for rrset in response.answer + response.authority)
+    if rcode in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+        for rrset in response.authority:
+            if rrset.rdtype == dns.rdatatype.SOA:
+                return min(rrset.ttl, rrset[0].minimum)
+    return None
+
+class LazyList(object):
+    """ Formats as `map(str, items)` would, but only when it comes to it """
+    __slots__ = ('items',)
+
+    def __init__(self, items):
+        self.items = items
+
+    def __str__(self):
+        return str(map(str, self.items))
+
+class QueryLog(object):
+    """
+    Logs lines about queries without holding them up. `write()` just puts
+    the format and its arguments on a bounded queue (or counts it in
+    `dropped` if the queue is full); a background thread formats whatever
+    has built up and writes it to `stream` in batches.
+    """
+    def __init__(self, stream, maxsize=10000, batch=500):
+        self.stream = stream
+        self.batch = batch
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = 0
+        self.writer = threading.Thread(target=self.write_batches, name='querylog')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def write(self, format, args):
+        try:
+            self.queue.put_nowait((time.time(), format, args))
+        except Queue.Full:
+            self.dropped += 1
+
+    def write_batches(self):
+        while True:
+            records = [self.queue.get()]
+            try:
+                while len(records) < self.batch:
+                    records.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            lines = []
+            for when, format, args in records:
+                try:
+                    message = format % args
+                except Exception:
+                    message = '%s %r' % (format, args)
+                stamp = time.strftime('%d/%m/%Y %I:%M:%S %p', time.localtime(when))
+                lines.append('[%s] %-10s %s\n' % (stamp, 'INFO', message))
+            try:
+                self.stream.write(''.join(lines))
+                self.stream.flush()
+            except (IOError, ValueError):
+                self.dropped += len(lines)
+
+    def close(self):
+        """ Give the writer a moment to catch up """
+        deadline = time.time() + 1
+        while not self.queue.empty() and time.time() < deadline:
+            time.sleep(0.01)
+
+class Histogram(object):
+    """
+    A latency histogram in the style of HdrHistogram: buckets are a
+    sixteenth of a power of two wide, so quantiles come out within about 3%
+    at any scale from a few hundred counters. Values are seconds, kept to the
+    microsecond.
+    """
+    def __init__(self):
+        self.buckets = collections.defaultdict(int)  # lowest value in bucket (us) -> count
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, seconds):
+        us = max(int(seconds * 1000000), 0)
+        shift = max(us.bit_length() - 5, 0)
+        self.buckets[us >> shift << shift] += 1
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, q):
+        """ The value (seconds) that a `q` fraction of recorded values are at or below """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for low in sorted(self.buckets):
+            seen += self.buckets[low]
+            if seen >= rank:
+                break
+        width = 1 << max(low.bit_length() - 5, 0)
+        return (low + width / 2.0) / 1000000
+
+class Metrics(object):
+    """
+    In-process counters and latency histograms, each identified by a name and
+    a tuple of (label, value) pairs, and rendered in Prometheus' text format
+    by `render()`.
+    """
+    quantiles = (0.5, 0.9, 0.99, 0.999)
+
+    def __init__(self, prefix='bdns'):
+        self.prefix = prefix
+        self.counters = collections.defaultdict(int)  # (name, labels) -> count
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.lock = threading.Lock()
+
+    def count(self, name, labels=(), n=1):
+        with self.lock:
+            self.counters[(name, labels)] += n
+
+    def observe(self, name, seconds, labels=()):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = Histogram()
+            histogram.record(seconds)
+
+    def render(self, gauges=()):
+        """
+        All the metrics, plus `gauges` given as (name, labels, value), in
+        Prometheus' text exposition format.
+        """
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (h.count, h.total, [(q, h.quantile(q)) for q in self.quantiles]))
+                    for key, h in self.histograms.items())
+        typed = set()
+        def metric(name, kind):
+            name = '%s_%s' % (self.prefix, name)
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s %s' % (name, kind))
+            return name
+        for (name, labels), value in counters:
+            lines.append('%s%s %d' % (metric(name + '_total', 'counter'), format_labels(labels), value))
+        for (name, labels), (count, total, quantiles) in histograms:
+            full = metric(name, 'summary')
+            for q, value in quantiles:
+                lines.append('%s%s %.6f' % (full, format_labels(labels + ('quantile', str(q))), value))
+            lines.append('%s_sum%s %.6f' % (full, format_labels(labels), total))
+            lines.append('%s_count%s %d' % (full, format_labels(labels), count))
+        for name, labels, value in gauges:
+            lines.append('%s%s %s' % (metric(name, 'gauge'), format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    """ ('a', 1, 'b', 2) -> '{a="1",b="2"}' """
+    if not labels:
+        return ''
+    pairs = []
+    for i in range(0, len(labels), 2):
+        value = str(labels[i + 1]).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('%s="%s"' % (labels[i], value))
+    return '{%s}' % ','.join(pairs)
+
+class StatsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    The admin endpoint: GET /metrics for Prometheus, and GET /capture to
+    write out the packet capture (see `PacketCapture`).
+    """
+    def do_GET(self):
+        state = self.server.state
+        if self.path == '/metrics':
+            self.send_text(200, state.render_metrics())
+        elif self.path == '/capture' and state.capture is not None:
+            self.send_text(200, state.capture.dump() + '\n')
+        else:
+            self.send_text(404, 'Not found\n')
+
+    def send_text(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('stats: ' + format, *args)
+
+class StatsServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Serves `StatsHandler` for a server's `state` """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, server_address, state):
+        self.state = state
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, StatsHandler)
+
+class SingleFlight(object):
+    """
+    Identical questions that arrive while one is already on its way upstream
+    wait for its answer rather than each being forwarded. The first to `join`
+    is the leader and does the forwarding, then calls `land` with the
+    response; everyone else's callback gets a copy under their own message
+    id. Waiters shouldn't wait longer than `timeout` for a leader.
+    """
+    timeout = 30
+
+    def __init__(self):
+        self.flights = {}  # key -> [(msg, callback)]
+        self.lock = threading.Lock()
+
+    def key(self, msg):
+        if len(msg.question) != 1 or msg.opcode() != dns.opcode.QUERY:
+            return None
+        question = msg.question[0]
+        return (question.name, question.rdtype, question.rdclass,
+                msg.flags & dns.flags.CD, msg.ednsflags & dns.flags.DO)
+
+    def join(self, msg, callback):
+        """
+        Returns True if the caller is the leader, or False if `callback` will
+        be called with the leader's response (or None) instead.
+        """
+        key = self.key(msg)
+        if key is None:
+            return True
+        with self.lock:
+            waiters = self.flights.get(key)
+            if waiters is None:
+                self.flights[key] = []
+                return True
+            waiters.append((msg, callback))
+            return False
+
+    def land(self, msg, response):
+        key = self.key(msg)
+        if key is None:
+            return
+        with self.lock:
+            waiters = self.flights.pop(key, [])
+        if not waiters:
+            return
+        wire = response.to_wire() if response is not None else None
+        for waiter, callback in waiters:
+            copy = None
+            if wire is not None:
+                copy = dns.message.from_wire(wire)
+                copy.id = waiter.id
+                copy.question = waiter.question
+            try:
+                callback(copy)
+            except Exception:
+                log.exception('could not hand on the answer to %s', waiter.id)
+
+class CacheEntry(object):
+    __slots__ = ('wire', 'stored', 'expires', 'hits', 'refreshing')
+
+    def __init__(self, wire, stored, expires, hits=0):
+        self.wire = wire
+        self.stored = stored
+        self.expires = expires
+        self.hits = hits
+        self.refreshing = False
+
+def refresh_query(msg):
+    """ A query of our own asking the same question as `msg`, with its CD and DO flags """
+    question = msg.question[0]
+    query = dns.message.make_query(question.name, question.rdtype, question.rdclass,
+            want_dnssec=bool(msg.ednsflags & dns.flags.DO))
+    query.flags |= msg.flags & dns.flags.CD
+    return query
+
+class ResponseCache(object):
+    """
+    A bounded LRU cache of upstream responses, keyed on (qname, qtype, qclass)
+    and the CD and DO flags, since those change what upstream answers with.
+    Entries are kept as wire data and re-parsed on the way out so that each
+    client gets its own message id and TTLs counted down to what is left.
+
+    Entries asked for at least `prefetch_hits` times are refreshed ahead of
+    time: once one is into the last `prefetch_fraction` of its TTL, the next
+    hit calls `refresh(msg)` (if set) to fetch it again in the background.
+    Expired entries are kept for another `stale` seconds, for `get_stale` to
+    fall back on when upstream isn't answering (RFC 8767).
+    """
+    prefetch_fraction = 0.1
+    stale_ttl = 30
+
+    def __init__(self, max_entries=10000, max_ttl=86400, stale=3600, prefetch_hits=3):
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self.stale = stale
+        self.prefetch_hits = prefetch_hits
+        self.refresh = None
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, msg):
+        question = msg.question[0]
+        return (question.name, question.rdtype, question.rdclass,
+                msg.flags & dns.flags.CD, msg.ednsflags & dns.flags.DO)
+
+    def lookup(self, key, now):
+        """ The entry for `key`, fresh or stale, moved to the back; call with `lock` held """
+        entry = self.entries.pop(key, None)
+        if entry is None or entry.expires + self.stale <= now:
+            return None
+        self.entries[key] = entry # most recently used goes to the back
+        return entry
+
+    def get(self, msg):
+        """ Return a cached response to `msg`, or None. """
+        key = self.key(msg)
+        now = time.time()
+        refresh = False
+        with self.lock:
+            entry = self.lookup(key, now)
+            if entry is None or entry.expires <= now:
+                return None
+            entry.hits += 1
+            if (self.refresh is not None and not entry.refreshing
+                    and entry.hits >= self.prefetch_hits
+                    and entry.expires - now < (entry.expires - entry.stored) * self.prefetch_fraction):
+                entry.refreshing = refresh = True
+        if refresh:
+            self.refresh(msg)
+        response = self.response(entry, msg)
+        elapsed = int(now - entry.stored)
+        for rrset in response.answer + response.authority + response.additional:
+            rrset.ttl = max(rrset.ttl - elapsed, 0)
+        return response
+
+    def has_stale(self, msg):
+        """ Whether there's an entry for `msg`, fresh or not, without parsing it """
+        if len(msg.question) != 1:
+            return False
+        with self.lock:
+            return self.lookup(self.key(msg), time.time()) is not None
+
+    def get_stale(self, msg):
+        """ Return a cached response to `msg` even if it has expired, or None. """
+        if len(msg.question) != 1:
+            return None
+        with self.lock:
+            entry = self.lookup(self.key(msg), time.time())
+        if entry is None:
+            return None
+        response = self.response(entry, msg)
+        for rrset in response.answer + response.authority + response.additional:
+            rrset.ttl = min(rrset.ttl, self.stale_ttl)
+        return response
+
+    def response(self, entry, msg):
+        response = dns.message.from_wire(entry.wire)
+        response.id = msg.id
+        response.flags = (response.flags & ~dns.flags.RD) | (msg.flags & dns.flags.RD)
+        response.question = msg.question
+        return response
+
+    def put(self, msg, response):
+        """ Remember `response` to `msg` for as long as its TTLs allow. """
+        if len(msg.question) != 1:
+            return
+        ttl = response_ttl(response)
+        if not ttl:
+            return
+        now = time.time()
+        entry = CacheEntry(response.to_wire(), now, now + min(ttl, self.max_ttl))
+        key = self.key(msg)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                # stays hot for a while, but has to keep earning it
+                entry.hits = old.hits / 2
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class TCPRequestHandler(SocketServer.StreamRequestHandler):
+    """ handles DNS over TCP: length prefixed messages, as many as the client likes """
+    timeout = 30
+
+    def handle(self):
+        try:
+            while True:
+                header = self.rfile.read(2)
+                if len(header) < 2:
+                    return
+                length, = struct.unpack('!H', header)
+                data = self.rfile.read(length)
+                if len(data) < length:
+                    return
+                started = time.time()
+                state = self.server.state
+                record = state.record_query(self.client_address, data)
+                protocol = state.protocol(tcp=True)
+                wire = protocol.handle(data)
+                if record is not None:
+                    record(wire)
+                state.answered(protocol, started)
+                self.wfile.write(struct.pack('!H', len(wire)) + wire)
+        except socket.error:
+            return
+
+class ReusePortMixIn:
+    """ Binds with SO_REUSEPORT if `reuse_port` is set, so several processes can share a port """
+    reuse_port = False
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        SocketServer.TCPServer.server_bind(self)
+
+class TCPServer(ReusePortMixIn, ThreadingMixIn, SocketServer.TCPServer):
+    """ Listens for TCP alongside a UDP `Server`, sharing its `state` """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, server_address, RequestHandlerClass, state, reuse_port=False):
+        self.state = state
+        self.reuse_port = reuse_port
+        SocketServer.TCPServer.__init__(self, server_address, RequestHandlerClass)
+
 class RequestHandler(SocketServer.BaseRequestHandler):
-    """ handles requests and does some bad non-threadsafe config reloading """
+    """ handles requests with whatever config is current when they arrive """
     def handle(self):
+        started = time.time()
         data, sock = self.request
-        self.server.config = getconfig() # XXX: race here!
-        protocol = DNSProtocol(self.server.config)
-        sock.sendto(protocol.handle(data), self.client_address)
+        record = self.server.record_query(self.client_address, data)
+        protocol = self.server.protocol()
+        wire = protocol.handle(data)
+        if record is not None:
+            record(wire)
+        sock.sendto(wire, self.client_address)
+        self.server.answered(protocol, started)
 
-class Server(ThreadingMixIn, UDPServer):
-    def __init__(self, server_address, RequestHandlerClass, config):
-        self.config = config
+class ServerState(object):
+    """ The state that outlives a single request, for either engine """
+    def init_state(self, configs, server_address, capture=None, querylog=None):
+        self.configs = configs
+        self.address = server_address
+        self.capture = capture
+        self.querylog = querylog
+        self.metrics = Metrics()
+        self.cache = ResponseCache(
+                getattr(configs.current, 'cache_size', 10000),
+                getattr(configs.current, 'cache_max_ttl', 86400),
+                getattr(configs.current, 'serve_stale', 3600),
+                getattr(configs.current, 'prefetch_hits', 3))
+        self.cache.refresh = self.refresh
+        configs.listeners.append(lambda config: self.cache.clear())
+        self.upstreams = Upstreams(self.metrics)
+        self.pool = TCPPool()
+        self.flights = SingleFlight()
+
+    def record_query(self, client, data):
+        """ See `PacketCapture.record_query` """
+        if self.capture is None:
+            return None
+        return self.capture.record_query(client, self.address, data)
+
+    def protocol(self, tcp=False):
+        """ A `DNSProtocol` for a request arriving now """
+        return DNSProtocol(self.configs.current, self.cache, self.upstreams,
+                self.pool, None if tcp else 512, self.flights, self.metrics, self.querylog)
+
+    def refresh(self, msg):
+        """ Refresh the cache's answer to `msg` from upstream, in the background """
+        query = refresh_query(msg)
+        self.metrics.count('prefetches')
+        thread = threading.Thread(target=self.protocol().refresh, args=(query,), name='prefetch')
+        thread.daemon = True
+        thread.start()
+
+    def answered(self, protocol, started):
+        """ Note how long `protocol`'s request took to answer """
+        self.metrics.observe('query_seconds', time.time() - started, ('outcome', protocol.outcome))
+
+    def gauges(self):
+        gauges = [('cache_entries', (), len(self.cache.entries))]
+        if self.querylog is not None:
+            gauges.append(('querylog_dropped', (), self.querylog.dropped))
+        for ns, stats in sorted(self.upstreams.stats.items()):
+            gauges.append(('upstream_srtt_seconds', ('upstream', ns), '%.6f' % stats.srtt))
+            gauges.append(('upstream_circuit_open', ('upstream', ns), int(stats.open_until > time.time())))
+        return gauges
+
+    def render_metrics(self):
+        return self.metrics.render(self.gauges())
+
+class Server(ServerState, ReusePortMixIn, ThreadingMixIn, UDPServer):
+    def __init__(self, server_address, RequestHandlerClass, configs, reuse_port=False,
+                 capture=None, querylog=None):
+        self.init_state(configs, server_address, capture, querylog)
+        self.reuse_port = reuse_port
         UDPServer.__init__(self, server_address, RequestHandlerClass)
 
+class UDPListener(asyncore.dispatcher):
+    """ Hands datagrams from clients to an `AsyncServer` """
+    def __init__(self, server_address, server):
+        asyncore.dispatcher.__init__(self, map=server.map)
+        self.server = server
+        self.create_socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if server.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        self.bind(server_address)
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            data, addr = self.socket.recvfrom(65535)
+        except socket.error:
+            return
+        self.server.handle_packet(data, lambda wire: self.reply(wire, addr), addr)
+
+    def reply(self, wire, addr):
+        try:
+            self.socket.sendto(wire, addr)
+        except socket.error as e:
+            log.warning('could not reply to %s: %s', addr, e)
+
+    def handle_error(self):
+        log.exception('error in listener')
+
+class TCPListener(asyncore.dispatcher):
+    """ Accepts TCP clients for an `AsyncServer` """
+    def __init__(self, server_address, server):
+        asyncore.dispatcher.__init__(self, map=server.map)
+        self.server = server
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        if server.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        self.bind(server_address)
+        self.listen(128)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            TCPClient(pair[0], self.server)
+
+    def handle_error(self):
+        log.exception('error in tcp listener')
+
+class TCPClient(asyncore.dispatcher_with_send):
+    """
+    One TCP client of an `AsyncServer`, sending length prefixed messages.
+    Closed by the server after `timeout` seconds without a word either way.
+    """
+    timeout = 30
+
+    def __init__(self, sock, server):
+        asyncore.dispatcher_with_send.__init__(self, sock, map=server.map)
+        self.server = server
+        self.received = ''
+        self.last_active = time.time()
+        server.tcp_clients.add(self)
+
+    def handle_read(self):
+        self.last_active = time.time()
+        self.received += self.recv(65535)
+        while len(self.received) >= 2:
+            length, = struct.unpack('!H', self.received[:2])
+            if len(self.received) < 2 + length:
+                break
+            data = self.received[2:2 + length]
+            self.received = self.received[2 + length:]
+            self.server.handle_packet(data, self.reply, self.addr, tcp=True)
+
+    def reply(self, wire):
+        if self.connected:
+            self.last_active = time.time()
+            self.send(struct.pack('!H', len(wire)) + wire)
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        self.server.tcp_clients.discard(self)
+        asyncore.dispatcher_with_send.close(self)
+
+    def handle_error(self):
+        log.exception('error talking to tcp client')
+        self.close()
+
+class Waker(asyncore.dispatcher):
+    """ Lets other threads get an `AsyncServer`'s loop to run something """
+    def __init__(self, server):
+        self.writer, reader = socket.socketpair()
+        self.writer.setblocking(0)
+        asyncore.dispatcher.__init__(self, reader, map=server.map)
+        self.calls = collections.deque()
+
+    def call_soon(self, fn):
+        self.calls.append(fn)
+        try:
+            self.writer.send('x')
+        except socket.error:
+            pass # full, so there's a wakeup waiting already
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        while self.calls:
+            self.calls.popleft()()
+
+    def handle_error(self):
+        log.exception('error in deferred call')
+
+class UpstreamDispatcher(asyncore.dispatcher):
+    """ Tells an `AsyncServer` when one of an `UpstreamQuery`'s sockets is readable """
+    def __init__(self, sock, query, server):
+        asyncore.dispatcher.__init__(self, sock, map=server.map)
+        self.query = query
+        self.server = server
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.query.on_readable(self.socket, time.time())
+        self.server.watch(self.query)
+
+    def handle_error(self):
+        log.exception('error reading from upstream')
+
+class AsyncServer(ServerState):
+    """
+    Single threaded alternative to `Server`. One asyncore loop takes packets
+    from clients and waits on the upstream sockets, so a thousand forwarded
+    queries in flight is a thousand sockets rather than a thousand threads. At
+    most `max_inflight` queries go upstream at once; past that, clients wait
+    in a queue of up to `backlog` and then get dropped.
+    """
+    def __init__(self, server_address, configs, max_inflight=1000, backlog=10000,
+                 tcp=True, reuse_port=False, capture=None, querylog=None):
+        self.init_state(configs, server_address, capture, querylog)
+        self.reuse_port = reuse_port
+        self.max_inflight = max_inflight
+        self.backlog = backlog
+        self.map = {}
+        self.inflight = {}  # UpstreamQuery -> (protocol, msg, nameservers, reply)
+        self.watched = {}   # UpstreamQuery -> {socket: UpstreamDispatcher}
+        self.waiting = collections.deque()
+        self.timers = []    # heap of (time, UpstreamQuery) wanting a poll()
+        self.stale_timers = []  # heap of (time, function) to answer stale
+        self.tcp_clients = set()
+        self.next_sweep = 0
+        self.listener = UDPListener(server_address, self)
+        self.tcp_listener = None
+        if tcp:
+            self.tcp_listener = TCPListener(server_address, self)
+        self.waker = Waker(self)
+
+    def handle_packet(self, data, reply, client, tcp=False):
+        """ Answer a client's `data`, calling `reply(wire)` when we have something to say """
+        started = time.time()
+        record = self.record_query(client, data)
+        protocol = self.protocol(tcp)
+        send = reply
+        replied = []
+        def reply(wire):
+            if replied:
+                return # already had a stale answer
+            replied.append(True)
+            if record is not None:
+                record(wire)
+            send(wire)
+            self.answered(protocol, started)
+        try:
+            wire = protocol.answer_static(data)
+            if wire is not None:
+                reply(wire)
+                return
+            msg = protocol.parse(data)
+            wire, nameservers = protocol.answer_locally(msg)
+        except Exception:
+            log.exception('could not handle request')
+            return
+        if wire is not None:
+            reply(wire)
+            return
+        if self.cache.has_stale(msg):
+            # answer stale if upstream keeps us waiting; the forward carries on
+            def stale():
+                if not replied:
+                    wire = protocol.stale_answer(msg)
+                    if wire is not None:
+                        reply(wire)
+            heapq.heappush(self.stale_timers, (started + protocol.stale_timeout, stale))
+        follow = lambda response: self.answer(protocol, msg, response, nameservers, reply, leader=False)
+        if not self.flights.join(msg, follow):
+            return # the same question is already on its way
+        if len(self.inflight) < self.max_inflight:
+            self.forward(protocol, msg, nameservers, reply)
+        elif len(self.waiting) < self.backlog:
+            self.waiting.append((protocol, msg, nameservers, reply))
+        else:
+            log.warning('%-10s%-8stoo many queries in flight', 'Dropped:', msg.id)
+            self.metrics.count('dropped')
+            self.flights.land(msg, None)
+
+    def forward(self, protocol, msg, nameservers, reply):
+        query = UpstreamQuery(protocol.upstream_message(msg), nameservers, self.upstreams,
+                port=getattr(protocol.config, 'upstream_port', 53))
+        self.inflight[query] = (protocol, msg, nameservers, reply)
+        query.start(time.time())
+        self.watch(query)
+
+    def watch(self, query):
+        """ Keep the asyncore map in step with the sockets `query` is waiting on. """
+        watched = self.watched.pop(query, {})
+        current = query.sockets()
+        for sock, dispatcher in watched.items():
+            if sock not in current:
+                if self.map.get(dispatcher._fileno) is dispatcher:
+                    del self.map[dispatcher._fileno]
+                del watched[sock]
+        if query.done:
+            self.complete(query)
+            return
+        for sock in current:
+            if sock not in watched:
+                watched[sock] = UpstreamDispatcher(sock, query, self)
+        self.watched[query] = watched
+        heapq.heappush(self.timers, (query.next_event(), query))
+
+    def complete(self, query):
+        protocol, msg, nameservers, reply = self.inflight.pop(query)
+        response = query.response
+        if response is not None and response.flags & dns.flags.TC:
+            # go get the rest over tcp, without holding up the loop
+            def retried(full):
+                self.waker.call_soon(lambda: self.answer(protocol, msg, full or response, nameservers, reply))
+            self.metrics.count('tcp_retries')
+            self.pool.defer(query.msg, query.nameserver, retried, query.port)
+        else:
+            self.answer(protocol, msg, response, nameservers, reply)
+        while self.waiting and len(self.inflight) < self.max_inflight:
+            self.forward(*self.waiting.popleft())
+
+    def answer(self, protocol, msg, response, nameservers, reply, leader=True):
+        try:
+            reply(protocol.finish(msg, response, nameservers, store=leader))
+        except Exception:
+            log.exception('could not answer %s', msg.id)
+        if leader:
+            self.flights.land(msg, response)
+
+    def refresh(self, msg):
+        query = refresh_query(msg)
+        protocol = self.protocol()
+        if len(self.inflight) >= self.max_inflight or not self.flights.join(query, lambda response: None):
+            return # busy, or someone else is asking anyway
+        self.metrics.count('prefetches')
+        self.forward(protocol, query, protocol.nameservers_for(query), lambda wire: None)
+
+    def gauges(self):
+        return ServerState.gauges(self) + [
+                ('upstream_inflight', (), len(self.inflight)),
+                ('backlog', (), len(self.waiting))]
+
+    def serve_forever(self):
+        while True:
+            timeout = 1.0
+            for timers in (self.timers, self.stale_timers):
+                if timers:
+                    timeout = min(max(timers[0][0] - time.time(), 0), timeout)
+            asyncore.loop(timeout=timeout, use_poll=True, map=self.map, count=1)
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                when, query = heapq.heappop(self.timers)
+                if query in self.inflight:
+                    query.poll(now)
+                    self.watch(query)
+            while self.stale_timers and self.stale_timers[0][0] <= now:
+                when, stale = heapq.heappop(self.stale_timers)
+                try:
+                    stale()
+                except Exception:
+                    log.exception('could not answer stale')
+            if now >= self.next_sweep:
+                self.close_idle(now)
+                self.next_sweep = now + 1
+
+    def close_idle(self, now):
+        """ Hang up on TCP clients that have gone quiet (RFC 7766 6.2.3) """
+        for client in list(self.tcp_clients):
+            if now - client.last_active > client.timeout:
+                client.close()
+
+    def server_close(self):
+        for query in self.inflight.keys():
+            query.close()
+        self.listener.close()
+        if self.tcp_listener is not None:
+            self.tcp_listener.close()
+
+class ConfigManager(object):
+    """
+    Keeps hold of the current config. Loading, validating and compiling a new
+    one happens in a background thread, off the request path, and `current`
+    is only ever swapped for a complete config, so handlers just read it. A
+    config that fails to load is logged and the last good one stays in place.
+
+    Reloads happen when bdns_settings.py changes (checked every `interval`
+    seconds) or on SIGHUP. `listeners` are called with each new config.
+    """
+    def __init__(self, loader, interval=2):
+        self.loader = loader
+        self.interval = interval
+        self.current = loader()
+        self.mtime = self.settings_mtime()
+        self.listeners = []
+        self.wakeup = threading.Event()
+
+    def settings_mtime(self):
+        try:
+            return os.path.getmtime(self.current.__file__)
+        except (AttributeError, OSError):
+            return None
+
+    def reload(self):
+        try:
+            config = self.loader()
+        except Exception:
+            log.exception('Could not reload bdns_settings.py, keeping the old config')
+            return False
+        self.current = config
+        self.mtime = self.settings_mtime()
+        for listener in self.listeners:
+            listener(config)
+        log.info('Reloaded bdns_settings.py')
+        return True
+
+    def start(self):
+        """ Start watching for changes, and reload on SIGHUP """
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.wakeup.set())
+        thread = threading.Thread(target=self.watch, name='config-watcher')
+        thread.daemon = True
+        thread.start()
+
+    def watch(self):
+        while True:
+            self.wakeup.wait(self.interval or None)
+            if self.wakeup.is_set():
+                self.wakeup.clear()
+                self.reload()
+            elif self.interval:
+                mtime = self.settings_mtime()
+                if mtime != self.mtime:
+                    self.mtime = mtime
+                    self.reload()
+
+class Supervisor(object):
+    """
+    Runs `workers` copies of the server in child processes, each calling
+    `run_worker(number)`. They all bind the same port with SO_REUSEPORT and the
+    kernel spreads clients between them, so parsing and building messages
+    isn't stuck on one core. Workers that die are started again, SIGHUP is
+    passed on so they reload their config (as is SIGUSR1, to dump packet
+    captures), and SIGTERM or ^C stops them all.
+    """
+    restart_delay = 1
+
+    def __init__(self, workers, run_worker):
+        self.workers = workers
+        self.run_worker = run_worker
+        self.children = {}  # pid -> worker number
+        self.stopping = False
+
+    def spawn(self, number):
+        pid = os.fork()
+        if pid == 0:
+            for signum in (signal.SIGHUP, signal.SIGUSR1, signal.SIGTERM):
+                signal.signal(signum, signal.SIG_DFL)
+            status = 1
+            try:
+                self.run_worker(number)
+                status = 0
+            except KeyboardInterrupt:
+                status = 0
+            except Exception:
+                log.exception('worker %d failed', number)
+            finally:
+                os._exit(status)
+        self.children[pid] = number
+        log.info('started worker %d (pid %d)', number, pid)
+
+    def signal_children(self, signum):
+        for pid in self.children:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def stop(self, *args):
+        self.stopping = True
+        self.signal_children(signal.SIGTERM)
+
+    def run(self):
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.signal_children(signal.SIGHUP))
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.signal_children(signal.SIGUSR1))
+        signal.signal(signal.SIGTERM, self.stop)
+        for number in range(self.workers):
+            self.spawn(number)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except KeyboardInterrupt:
+                self.stop()
+                continue
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            number = self.children.pop(pid, None)
+            if number is None or self.stopping:
+                continue
+            log.warning('worker %d (pid %d) died with status %d, restarting', number, pid, status)
+            time.sleep(self.restart_delay)
+            self.spawn(number)
+
 class ConfigException(Exception): 
     pass
 
@@ -140,52 +1920,262 @@ def isip(s):
     except socket.error:
         return False
 
-def getconfig():
-    """ Read and validate config. Also resolve any nameserver names 
-    TODO: log info on resolving dnses """
+class NameserverNames(object):
+    """
+    Resolves the nameserver names used in `hosts` rules, all at once rather
+    than one after another, and keeps each answer for its TTL. A background
+    thread resolves every name again as it expires and updates the resolved
+    nameserver lists of the current rules in place, so an address change
+    takes effect without reloading the config. If a name stops resolving,
+    its last addresses are kept and it's retried every `retry` seconds.
+    """
+    concurrency = 100
+    min_ttl = 30
+    retry = 30
+    timeout = 5
+
+    def __init__(self):
+        self.cache = {}  # name -> (addresses, expires)
+        self.rules = []  # (nameserver names and ips, resolved list) for the current config
+        self.nameservers = []
+        self.port = 53
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def lookup(self, name, nameservers, port):
+        resolver = dns.resolver.Resolver(configure=False)
+        resolver.nameservers = list(nameservers)
+        resolver.port = port
+        resolver.timeout = resolver.lifetime = self.timeout
+        answer = resolver.query(name)
+        return [rdata.address for rdata in answer], max(answer.rrset.ttl, self.min_ttl)
+
+    def resolve(self, names, nameservers, port):
+        """ Look up `names` concurrently. Returns {name: error} for those that failed. """
+        queue = Queue.Queue()
+        for name in set(names):
+            queue.put(name)
+        failed = {}
+        def work():
+            while True:
+                try:
+                    name = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    addresses, ttl = self.lookup(name, nameservers, port)
+                except Exception as e:
+                    failed[name] = e
+                    continue
+                with self.lock:
+                    self.cache[name] = (addresses, time.time() + ttl)
+        threads = [threading.Thread(target=work, name='resolve-%d' % i)
+                   for i in range(min(self.concurrency, queue.qsize()))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return failed
+
+    def expand(self, nameservers):
+        """ `nameservers` with each name replaced by its addresses """
+        addresses = []
+        for thing in nameservers:
+            if isip(thing):
+                addresses.append(thing)
+            else:
+                addresses.extend(self.cache[thing][0])
+        return addresses
+
+    def load(self, hosts, nameservers, port=53):
+        """
+        Resolve the names in the nameserver lists of `hosts`, a list of
+        (key, value) pairs, using `nameservers` on `port`. Returns the pairs with each
+        nameserver list resolved, and makes them the ones kept up to date.
+        """
+        now = time.time()
+        names = set(thing for key, value in hosts if isinstance(value, list)
+                    for thing in value if not isip(thing))
+        expired = [name for name in names
+                   if name not in self.cache or self.cache[name][1] <= now]
+        for name, error in self.resolve(expired, nameservers, port).items():
+            if name not in self.cache:
+                raise ConfigException("`%s` does not look like "
+                        "an ipv4 address and does not resolve "
+                        "using the default nameservers (%s)" % (name, error))
+            log.warning('could not resolve nameserver %s again (%s), still using %s',
+                        name, error, ', '.join(self.cache[name][0]))
+        resolved = []
+        rules = []
+        for key, value in hosts:
+            if isinstance(value, list) and not all(isip(thing) for thing in value):
+                addresses = self.expand(value)
+                rules.append((value, addresses))
+                value = addresses
+            resolved.append((key, value))
+        with self.lock:
+            self.rules = rules
+            self.nameservers = nameservers
+            self.port = port
+        if rules and (self.thread is None or not self.thread.is_alive()):
+            # (not alive in a worker forked from a process that had one)
+            self.thread = threading.Thread(target=self.refresh, name='nameserver-names')
+            self.thread.daemon = True
+            self.thread.start()
+        self.wakeup.set()
+        return resolved
+
+    def refresh(self):
+        while True:
+            with self.lock:
+                names = set(thing for value, addresses in self.rules
+                            for thing in value if not isip(thing))
+                expires = [self.cache[name][1] for name in names if name in self.cache]
+            self.wakeup.wait(max(min(expires) - time.time(), 0) if expires else None)
+            self.wakeup.clear()
+            now = time.time()
+            with self.lock:
+                expired = [name for name in names if self.cache[name][1] <= now]
+                nameservers, port = self.nameservers, self.port
+            if not expired:
+                continue
+            failed = self.resolve(expired, nameservers, port)
+            with self.lock:
+                for name, error in failed.items():
+                    log.warning('could not resolve nameserver %s again (%s), still using %s',
+                                name, error, ', '.join(self.cache[name][0]))
+                    self.cache[name] = (self.cache[name][0], now + self.retry)
+                for value, addresses in self.rules:
+                    if any(thing in expired for thing in value):
+                        updated = self.expand(value)
+                        if updated != addresses:
+                            log.info('nameservers %s now resolve to %s', value, updated)
+                            addresses[:] = updated
+
+nameserver_names = NameserverNames()
+
+def getconfig(directory=None):
+    """ Read and validate config, from `directory` if given rather than the
+    python path. Nameserver names are resolved by `nameserver_names`. """
 
     try:
-        fp, path, desc = imp.find_module('bdns_settings')
+        fp, path, desc = imp.find_module('bdns_settings', directory and [directory])
         try:
+            # load into a fresh module so that anyone still holding the
+            # previous config doesn't see it change underneath them
+            sys.modules.pop('bdns_settings', None)
             bdns_settings = imp.load_module('bdns_settings', fp, path, desc)
         finally:
             if fp:
                 fp.close()
     except ImportError:
         log.error("Could not load bdns_settings.py. Using defaults.")
-        return {'default': '8.8.8.8'}
+        bdns_settings = imp.new_module('bdns_settings')
+        bdns_settings.default = ['8.8.8.8']
+        bdns_settings.hosts = {}
 
     try:
         default_nameservers = bdns_settings.default
-    except KeyError:
+    except AttributeError:
         raise ConfigException('No "default" found in bdns_settings.py')
     for ns in default_nameservers:
         if not isip(ns):
             raise ConfigException("Bad default nameserver IP: `%s`" % ns)
-    for key, value in bdns_settings.hosts.iteritems():
-        if isinstance(value, list): # nameserver
-            for thing in value:
-                if not isip(thing):
-                    resolver = dns.resolver.get_default_resolver()
-                    resolver.nameservers = default_nameservers
-                    try:
-                        answer = resolver.query(thing)
-                        bdns_settings.hosts[key] = [answer[0].address]
-                    except:
-                        raise ConfigException("`%s` does not look like "
-                                "an ipv4 address and does not resolve "
-                                "using the default nameservers" % thing)
-        else: # should be a valid ip
-            if not isip(value):
-                raise ConfigException("`%s` is not a valid "
-                                      "ipv4 address" % value)
+    hosts = host_items(bdns_settings.hosts)
+    for key, value in hosts:
+        if not isinstance(value, list) and not isip(value): # should be a valid ip
+            raise ConfigException("`%s` is not a valid "
+                                  "ipv4 address" % value)
+    hosts = nameserver_names.load(hosts, default_nameservers,
+            getattr(bdns_settings, 'upstream_port', 53))
+    if hasattr(bdns_settings.hosts, 'items'):
+        hosts = dict(hosts)
+    bdns_settings.rules = HostIndex(hosts)
     return bdns_settings
 
-if __name__ == '__main__':
-    server = Server(("0.0.0.0", 53), RequestHandler, getconfig())
+def serve(options, reuse_port=False, number=0):
+    configs = ConfigManager(lambda: getconfig(options.settings), options.reload_interval)
+    configs.start()
+    capture = None
+    if options.capture:
+        capture = PacketCapture(options.capture, options.capture_sample,
+                options.capture_name, options.capture_client, options.capture_file)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: capture.dump_soon())
+    querylog = None
+    if options.query_log == '-':
+        querylog = QueryLog(sys.stderr)
+    elif options.query_log != 'off':
+        querylog = QueryLog(open(options.query_log, 'a'))
+    address = (options.bind, options.port)
+    if options.engine == 'asyncore':
+        server = AsyncServer(address, configs, options.max_inflight,
+                tcp=options.tcp, reuse_port=reuse_port, capture=capture, querylog=querylog)
+    else:
+        server = Server(address, RequestHandler, configs, reuse_port, capture, querylog)
+        if options.tcp:
+            tcp_server = TCPServer(address, TCPRequestHandler, server, reuse_port)
+            tcp_thread = threading.Thread(target=tcp_server.serve_forever, name='tcp')
+            tcp_thread.daemon = True
+            tcp_thread.start()
+    if options.stats_port:
+        stats_server = StatsServer((options.stats_bind, options.stats_port + number), server)
+        stats_thread = threading.Thread(target=stats_server.serve_forever, name='stats')
+        stats_thread.daemon = True
+        stats_thread.start()
     try: 
         server.serve_forever()
     except KeyboardInterrupt:
         print "Shutting down..."
         server.server_close()
+        if querylog is not None:
+            querylog.close()
+
+if __name__ == '__main__':
+    from optparse import OptionParser, OptionGroup
+    parser = OptionParser('%prog [options]')
+    parser.add_option('--engine', choices=['threaded', 'asyncore'], default='threaded',
+            help='threaded (a thread per request) or asyncore (one event loop) [%default]')
+    parser.add_option('--bind', default='0.0.0.0', help='address to listen on [%default]')
+    parser.add_option('--port', type='int', default=53, help='port to listen on [%default]')
+    parser.add_option('--no-tcp', dest='tcp', action='store_false', default=True,
+            help="don't listen for TCP")
+    parser.add_option('--workers', type='int', default=0,
+            help='run this many worker processes sharing the port with '
+                 'SO_REUSEPORT, rather than serving from this one [%default]')
+    parser.add_option('--max-inflight', type='int', default=1000,
+            help='most upstream queries at once with --engine=asyncore [%default]')
+    parser.add_option('--reload-interval', type='float', default=2,
+            help='seconds between checks for a changed bdns_settings.py, 0 to '
+                 'only reload on SIGHUP [%default]')
+    parser.add_option('--settings', metavar='DIR',
+            help='directory to load bdns_settings.py from, instead of the python path')
+    parser.add_option('--query-log', default='-', metavar='PATH',
+            help='file to log queries and answers to, written in the background; '
+                 '- for stderr, off for none [%default]')
+    parser.add_option('--stats-port', type='int', default=0,
+            help='serve Prometheus metrics on http://STATS_BIND:STATS_PORT/metrics; '
+                 'with --workers, worker N uses STATS_PORT + N [off]')
+    parser.add_option('--stats-bind', default='127.0.0.1',
+            help='address for --stats-port [%default]')
+    capture = OptionGroup(parser, 'Packet capture',
+            'Keep recent packets in memory, written to a pcap file on SIGUSR1 '
+            'or GET /capture on the stats port')
+    capture.add_option('--capture', type='int', default=0, metavar='PACKETS',
+            help='how many packets to keep, 0 for none [%default]')
+    capture.add_option('--capture-sample', type='float', default=1.0, metavar='FRACTION',
+            help='fraction of queries to keep [%default]')
+    capture.add_option('--capture-name', metavar='REGEX',
+            help='only keep queries for names matching this')
+    capture.add_option('--capture-client', action='append', metavar='IP',
+            help='only keep queries from this client (can be given more than once)')
+    capture.add_option('--capture-file', default='bdns-%(pid)d.pcap', metavar='PATH',
+            help='where to write it; %(pid)d is the process id [%default]')
+    parser.add_option_group(capture)
+    options, args = parser.parse_args()
 
+    if options.workers:
+        getconfig(options.settings) # fail now rather than in every worker
+        Supervisor(options.workers, lambda number: serve(options, True, number)).run()
+    else:
+        serve(options)
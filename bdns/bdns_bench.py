@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+"""
+Load test for bdns.py.
+
+Starts a stub nameserver in this process (authoritative for everything, with
+a configurable delay and loss), runs bdns.py against it once per engine, and
+fires a mix of queries at it at a fixed rate:
+
+  static    exact names from `hosts`, answered from the pre-encoded records
+  regex     names only a regular expression in `hosts` matches
+  forward   a fixed set of names sent to the stub, so mostly cache hits
+  random    a fresh name every time, so every one goes to the stub
+
+and reports, per engine, the rate it kept up, latency percentiles and the
+CPU bdns used per query.
+
+  $ python bdns_bench.py --qps 2000 --duration 10 --latency 5 --loss 0.01
+  $ python bdns_bench.py --mix static=1 --engine asyncore
+"""
+import os
+import sys
+import time
+import socket
+import struct
+import random
+import heapq
+import errno
+import shutil
+import tempfile
+import threading
+import subprocess
+
+from bdns import read_question
+
+BDNS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bdns.py')
+
+SETTINGS = """
+import re
+default = ['127.0.0.1']
+upstream_port = %(port)d
+hosts = dict(('host%%d.bench.test' %% i, '10.0.%%d.%%d' %% (i / 250, i %% 250 + 1))
+             for i in range(%(static)d))
+hosts[re.compile(r'.*\\.regex\\.bench\\.test')] = '10.1.0.1'
+"""
+
+STATIC_NAMES = 1000
+FORWARD_NAMES = 1000
+
+def static_name():
+    return 'host%d.bench.test' % random.randrange(STATIC_NAMES)
+
+def regex_name():
+    return 'r%d.regex.bench.test' % random.randrange(STATIC_NAMES)
+
+def forward_name():
+    return 'name%d.forward.test' % random.randrange(FORWARD_NAMES)
+
+def random_name():
+    return '%08x.random.test' % random.getrandbits(32)
+
+NAMES = {
+    'static': static_name,
+    'regex': regex_name,
+    'forward': forward_name,
+    'random': random_name,
+}
+
+def encode_query(qid, name):
+    """ Wire format A query for `name` """
+    labels = ''.join(chr(len(label)) + label for label in name.split('.'))
+    return struct.pack('!HHHHHH', qid, 0x0100, 1, 0, 0, 0) + labels + '\x00\x00\x01\x00\x01'
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class StubServer(object):
+    """
+    Answers every query with a single A record, `latency` seconds after it
+    arrives, except for a `loss` fraction of them which it just ignores.
+    """
+    def __init__(self, latency=0, loss=0, ttl=300):
+        self.latency = latency
+        self.loss = loss
+        self.ttl = ttl
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.queries = 0
+        self.pending = []
+        self.ready = threading.Condition()
+
+    def start(self):
+        for target in (self.receive, self.send):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def respond(self, data):
+        question = read_question(data)
+        if question is None:
+            return None
+        end = question[3]
+        record = struct.pack('!HHHIH', 0xc00c, 1, 1, self.ttl, 4) + '\x7f\x00\x00\x01'
+        return (data[:2] + struct.pack('!HHHHH', 0x8580, 1, 1, 0, 0)
+                + data[12:end] + record)
+
+    def receive(self):
+        while True:
+            data, client = self.sock.recvfrom(4096)
+            self.queries += 1
+            if self.loss and random.random() < self.loss:
+                continue
+            response = self.respond(data)
+            if response is None:
+                continue
+            if not self.latency:
+                self.sock.sendto(response, client)
+                continue
+            with self.ready:
+                heapq.heappush(self.pending, (time.time() + self.latency, response, client))
+                self.ready.notify()
+
+    def send(self):
+        while True:
+            with self.ready:
+                while not self.pending or self.pending[0][0] > time.time():
+                    self.ready.wait(self.pending and self.pending[0][0] - time.time() or None)
+                due, response, client = heapq.heappop(self.pending)
+            self.sock.sendto(response, client)
+
+class LoadGenerator(object):
+    """
+    Sends queries to `address` at `qps` for `duration` seconds, on schedule
+    whether or not earlier ones have been answered, and times the answers.
+    """
+    def __init__(self, address, mix, qps, duration, timeout=2):
+        self.address = address
+        self.qps = qps
+        self.duration = duration
+        self.timeout = timeout
+        self.kinds = []
+        for kind, weight in mix:
+            self.kinds.extend([NAMES[kind]] * weight)
+        self.sent = {}
+        self.latencies = []
+        self.stopping = 0
+
+    def receive(self, sock):
+        while not self.stopping or time.time() < self.stopping:
+            try:
+                data = sock.recv(4096)
+            except socket.timeout:
+                continue
+            except socket.error as e:
+                if e.errno == errno.ECONNREFUSED:
+                    continue
+                return
+            started = self.sent.pop(struct.unpack('!H', data[:2])[0], None)
+            if started is not None:
+                self.latencies.append(time.time() - started)
+
+    def run(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        sock.connect(self.address)
+        sock.settimeout(0.1)
+        receiver = threading.Thread(target=self.receive, args=(sock,))
+        receiver.daemon = True
+        receiver.start()
+        count = 0
+        qid = random.randrange(65536)
+        started = time.time()
+        end = started + self.duration
+        while True:
+            now = time.time()
+            if now >= end:
+                break
+            due = started + count / float(self.qps)
+            if due > now:
+                time.sleep(due - now)
+            qid = (qid + 1) & 0xffff
+            self.sent[qid] = time.time()
+            try:
+                sock.send(encode_query(qid, random.choice(self.kinds)()))
+            except socket.error:
+                pass
+            count += 1
+        elapsed = time.time() - started
+        self.stopping = time.time() + self.timeout
+        receiver.join()
+        sock.close()
+        return count, elapsed
+
+def cpu_seconds(pid):
+    """ User + system CPU time used so far by process `pid`, or None """
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except IOError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return float('nan')
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def wait_until_answering(address, timeout=10):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(0.2)
+    deadline = time.time() + timeout
+    try:
+        while time.time() < deadline:
+            sock.sendto(encode_query(1, 'host0.bench.test'), address)
+            try:
+                sock.recvfrom(4096)
+                return True
+            except socket.error:
+                pass
+        return False
+    finally:
+        sock.close()
+
+def bench(engine, options, stub, settings_dir):
+    address = ('127.0.0.1', free_port())
+    command = [sys.executable, BDNS, '--engine', engine, '--bind', address[0],
+               '--port', str(address[1]), '--settings', settings_dir,
+               '--query-log', 'off'] + options.bdns_args
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(command, stdout=devnull, stderr=devnull)
+    try:
+        if not wait_until_answering(address):
+            raise RuntimeError('bdns (%s) did not start answering' % engine)
+        if options.warmup:
+            LoadGenerator(address, options.mix, options.qps, options.warmup).run()
+        upstream = stub.queries
+        cpu = cpu_seconds(process.pid)
+        load = LoadGenerator(address, options.mix, options.qps, options.duration)
+        sent, elapsed = load.run()
+        if cpu is not None:
+            cpu = cpu_seconds(process.pid) - cpu
+        upstream = stub.queries - upstream
+    finally:
+        process.terminate()
+        process.wait()
+    latencies = sorted(load.latencies)
+    answered = len(latencies)
+    return {
+        'engine': engine,
+        'sent': sent,
+        'answered': answered,
+        'lost': 100.0 * (sent - answered) / max(sent, 1),
+        'qps': answered / elapsed,
+        'p50': percentile(latencies, 0.5) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'p999': percentile(latencies, 0.999) * 1000,
+        'cpu': cpu is not None and cpu / max(answered, 1) * 1e6 or float('nan'),
+        'upstream': upstream,
+    }
+
+def parse_mix(text):
+    mix = []
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in NAMES:
+            raise ValueError('unknown query kind `%s` (one of %s)' % (kind, ', '.join(sorted(NAMES))))
+        mix.append((kind, int(weight or 1)))
+    return mix
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser('%prog [options] [-- bdns options]')
+    parser.add_option('--engine', action='append', choices=['threaded', 'asyncore'],
+            help='engine to run (can be given more than once) [both]')
+    parser.add_option('--qps', type='float', default=1000,
+            help='queries per second to send [%default]')
+    parser.add_option('--duration', type='float', default=10,
+            help='seconds to send them for [%default]')
+    parser.add_option('--warmup', type='float', default=1,
+            help='seconds of load to send first, not counted [%default]')
+    parser.add_option('--mix', default='static=40,regex=20,forward=30,random=10',
+            help='query kinds and their weights [%default]')
+    parser.add_option('--latency', type='float', default=0,
+            help='milliseconds the stub nameserver waits before answering [%default]')
+    parser.add_option('--loss', type='float', default=0,
+            help='fraction of queries the stub nameserver ignores [%default]')
+    parser.add_option('--seed', type='int', default=0,
+            help='random seed, so runs ask the same names [%default]')
+    options, args = parser.parse_args()
+    try:
+        options.mix = parse_mix(options.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    options.bdns_args = args
+    random.seed(options.seed)
+
+    stub = StubServer(options.latency / 1000.0, options.loss)
+    stub.start()
+    settings_dir = tempfile.mkdtemp(prefix='bdns-bench-')
+    try:
+        with open(os.path.join(settings_dir, 'bdns_settings.py'), 'w') as f:
+            f.write(SETTINGS % {'port': stub.port, 'static': STATIC_NAMES})
+        print '%g qps for %gs, mix %s, upstream latency %gms loss %g' % (
+                options.qps, options.duration,
+                ','.join('%s=%d' % pair for pair in options.mix),
+                options.latency, options.loss)
+        print '%-10s %8s %8s %7s %9s %8s %8s %8s %10s %9s' % ('engine', 'sent',
+                'answered', 'lost%', 'qps', 'p50ms', 'p99ms', 'p999ms', 'cpu/query', 'upstream')
+        for engine in options.engine or ['threaded', 'asyncore']:
+            result = bench(engine, options, stub, settings_dir)
+            print ('%(engine)-10s %(sent)8d %(answered)8d %(lost)7.2f %(qps)9.1f '
+                   '%(p50)8.2f %(p99)8.2f %(p999)8.2f %(cpu)8.0fus %(upstream)9d' % result)
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(settings_dir)
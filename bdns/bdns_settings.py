@@ -1,5 +1,23 @@
 default = ['192.168.0.1']
 
+# optional: how many forwarded answers to cache, and the longest (in seconds)
+# any of them is kept for regardless of its TTL.
+# cache_size = 10000
+# cache_max_ttl = 86400
+
+# optional: how long (seconds) past its TTL an answer may still be served if
+# the nameservers for it stop answering, and how many times an answer has to
+# be asked for before it's refreshed in the background as it nears expiry.
+# serve_stale = 3600
+# prefetch_hits = 3
+
+# optional: the port the nameservers below are asked on.
+# upstream_port = 53
+
+# optional: the EDNS0 UDP payload size advertised to clients and nameservers,
+# or 0 to forward queries without adding EDNS.
+# edns_payload = 1232
+
 import re
 hosts = {
     # exact name match, resolve to static ip
@@ -8,10 +26,17 @@ hosts = {
     # exact name match, resolve using nameservers (8.8.8.8, and 8.8.4.4)
     'www.google.com': ['8.8.8.8', '8.8.4.4'],
 
+    # any name under a domain (but not the domain itself)
+    '*.mydomain.com': ['10.0.0.1'],
+
     # regular expression matching
     re.compile('.*\.somethingelse\.com'): '127.0.0.1',
 }
 
+# Exact names win over wildcard domains (longest first), which win over
+# regular expressions. If the order of your regular expressions matters, make
+# `hosts` a list of (key, value) pairs instead of a dict.
+
 # something a little more dynamic...
 import random
 rand = random.randrange(2,255)
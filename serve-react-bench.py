@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+"""
+load test for serve-react.py.
+
+builds a throwaway public directory (a small index.html, big hashed js bundles and a media
+file), starts serve-react.py on it in each serving mode, and has `--concurrency` keep-alive
+clients hammer it with a mix of the root page, client side routes, bundles and ranged media
+reads. each mode is run four ways: plain requests, conditional requests (If-None-Match with
+the ETags seen so far), with Accept-Encoding, and crowded: plain requests while `--idle` more
+keep-alive connections (by default twice as many as the workers have threads) sit open after
+a request each, the way browser tabs do. reports requests/sec, latency percentiles and the
+server's peak RSS (all its processes together).
+
+  $ ./serve-react-bench.py --duration 10 --concurrency 32 --workers 4
+"""
+
+import os
+import sys
+import time
+import random
+import signal
+import socket
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+import http.client
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+SERVER = os.path.join(BASE_DIR, 'serve-react.py')
+
+ROUTES = 1000
+SCENARIOS = ['plain', 'conditional', 'compressed', 'crowded']
+
+def hashed_name(name, contents):
+	base, ext = os.path.splitext(name)
+	return '%s.%s%s' % (base, hashlib.md5(contents).hexdigest()[:8], ext)
+
+def make_public(root, bundles, bundle_size, media_size):
+	""" write the public directory, and return the paths of the bundles and the media file """
+	with open(os.path.join(root, 'index.html'), 'w') as f:
+		f.write('<!doctype html><html><head><title>bench</title></head><body><div id="root"></div></body></html>\n')
+	os.makedirs(os.path.join(root, 'static', 'js'))
+	os.makedirs(os.path.join(root, 'static', 'media'))
+	paths = []
+	words = ['function', 'return', 'const', 'props', 'state', 'React', 'createElement', 'useEffect', 'null', 'this']
+	for i in range(bundles):
+		source = []
+		size = 0
+		while size < bundle_size:
+			line = 'var %s%d = %s(%d);\n' % (random.choice(words), size, random.choice(words), random.randrange(1 << 20))
+			source.append(line)
+			size += len(line)
+		contents = ''.join(source).encode('ascii')
+		name = hashed_name('chunk%d.js' % i, contents)
+		with open(os.path.join(root, 'static', 'js', name), 'wb') as f:
+			f.write(contents)
+		paths.append('/static/js/' + name)
+	contents = os.urandom(media_size)
+	name = hashed_name('intro.mp4', contents)
+	with open(os.path.join(root, 'static', 'media', name), 'wb') as f:
+		f.write(contents)
+	return paths, '/static/media/' + name
+
+def free_port():
+	sock = socket.socket()
+	sock.bind(('127.0.0.1', 0))
+	port = sock.getsockname()[1]
+	sock.close()
+	return port
+
+def process_tree(pid):
+	""" `pid` and all its descendants """
+	children = {}
+	for entry in os.listdir('/proc'):
+		if not entry.isdigit():
+			continue
+		try:
+			with open('/proc/%s/stat' % entry) as f:
+				ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+		except (IOError, IndexError, ValueError):
+			continue
+		children.setdefault(ppid, []).append(int(entry))
+	pids = [pid]
+	for p in pids:
+		pids.extend(children.get(p, []))
+	return pids
+
+def rss(pid):
+	""" resident memory, in bytes, of `pid` and its descendants (0 if /proc isn't there) """
+	total = 0
+	for p in process_tree(pid) if os.path.isdir('/proc') else []:
+		try:
+			with open('/proc/%d/status' % p) as f:
+				for line in f:
+					if line.startswith('VmRSS:'):
+						total += int(line.split()[1]) * 1024
+		except IOError:
+			pass
+	return total
+
+class Client(object):
+	""" one keep-alive connection making requests until `stop` """
+	def __init__(self, port, requests, scenario, etags):
+		self.port = port
+		self.requests = requests
+		self.scenario = scenario
+		self.etags = etags
+		self.latencies = []
+		self.errors = 0
+		self.bytes = 0
+
+	def run(self, stop, requests=None):
+		""" make random requests until `stop`, or each of `requests` once """
+		conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+		while requests or (requests is None and time.time() < stop):
+			path, headers = requests.pop() if requests else random.choice(self.requests)
+			headers = dict(headers)
+			if self.scenario == 'compressed':
+				headers['Accept-Encoding'] = 'gzip, br'
+			elif self.scenario == 'conditional' and path in self.etags:
+				headers['If-None-Match'] = self.etags[path]
+			started = time.time()
+			try:
+				conn.request('GET', path, headers=headers)
+				response = conn.getresponse()
+				body = response.read()
+			except (OSError, http.client.HTTPException):
+				self.errors += 1
+				conn.close()
+				continue
+			self.latencies.append(time.time() - started)
+			self.bytes += len(body)
+			if response.status >= 400:
+				self.errors += 1
+			elif response.getheader('ETag') and 'Range' not in headers:
+				self.etags[path] = response.getheader('ETag')
+		conn.close()
+
+def percentile(ordered, fraction):
+	if not ordered:
+		return float('nan')
+	return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def wait_until_listening(port, timeout=15):
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		try:
+			socket.create_connection(('127.0.0.1', port), 0.2).close()
+			return True
+		except OSError:
+			time.sleep(0.1)
+	return False
+
+def bench(mode, args, public, requests):
+	port = free_port()
+	command = [sys.executable, SERVER, public, '--port', str(port), '--access-log', os.devnull]
+	if mode == 'workers':
+		command += ['--workers', str(args.workers), '--threads', str(args.threads)]
+	server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	results = []
+	try:
+		if not wait_until_listening(port):
+			raise RuntimeError("serve-react.py (%s) didn't start listening" % mode)
+		for scenario in SCENARIOS:
+			etags = {}
+			clients = [Client(port, requests, scenario, etags) for i in range(args.concurrency)]
+			# everyone asks for everything once first, so what's measured is the steady state:
+			# compressed copies made, and ETags known for conditional requests
+			distinct = list(set((path, tuple(headers.items())) for path, headers in requests))
+			warmup = [threading.Thread(target=client.run, args=(None, [(path, dict(headers)) for path, headers in distinct]))
+				for client in clients]
+			for thread in warmup:
+				thread.start()
+			for thread in warmup:
+				thread.join()
+			for client in clients:
+				client.latencies, client.errors, client.bytes = [], 0, 0
+			idle = []
+			if scenario == 'crowded':
+				for i in range(args.idle or 2 * args.threads * args.workers):
+					conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+					conn.request('GET', '/')
+					conn.getresponse().read()
+					idle.append(conn)
+			peak = [rss(server.pid)]
+			stop = time.time() + args.duration
+			threads = [threading.Thread(target=client.run, args=(stop,)) for client in clients]
+			started = time.time()
+			for thread in threads:
+				thread.start()
+			while any(thread.is_alive() for thread in threads):
+				peak.append(rss(server.pid))
+				time.sleep(0.2)
+			elapsed = time.time() - started
+			for conn in idle:
+				conn.close()
+			latencies = sorted(latency for client in clients for latency in client.latencies)
+			results.append({
+				'mode': mode,
+				'scenario': scenario,
+				'requests': len(latencies),
+				'errors': sum(client.errors for client in clients),
+				'rps': len(latencies) / elapsed,
+				'mbps': sum(client.bytes for client in clients) / elapsed / 1e6,
+				'p50': percentile(latencies, 0.5) * 1000,
+				'p99': percentile(latencies, 0.99) * 1000,
+				'p999': percentile(latencies, 0.999) * 1000,
+				'rss': max(peak) / 1e6,
+			})
+	finally:
+		server.send_signal(signal.SIGTERM)
+		try:
+			server.wait(10)
+		except subprocess.TimeoutExpired:
+			server.kill()
+			server.wait()
+	return results
+
+if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser(description="load test serve-react.py")
+	parser.add_argument('--mode', action='append', choices=['dev', 'workers'],
+		help="serving mode to test, can be given more than once (default: both)")
+	parser.add_argument('--workers', type=int, default=4, help="workers for the workers mode (default: %(default)s)")
+	parser.add_argument('--threads', type=int, default=16, help="threads per worker (default: %(default)s)")
+	parser.add_argument('--idle', type=int, default=0,
+		help="idle keep-alive connections in the crowded scenario (default: twice the workers' threads)")
+	parser.add_argument('--concurrency', type=int, default=16, help="keep-alive clients (default: %(default)s)")
+	parser.add_argument('--duration', type=float, default=5, help="seconds per scenario (default: %(default)s)")
+	parser.add_argument('--bundles', type=int, default=4, help="hashed js bundles (default: %(default)s)")
+	parser.add_argument('--bundle-size', type=int, default=1024 * 1024, help="bytes per bundle (default: %(default)s)")
+	parser.add_argument('--media-size', type=int, default=8 * 1024 * 1024, help="bytes of media file (default: %(default)s)")
+	parser.add_argument('--seed', type=int, default=0, help="random seed (default: %(default)s)")
+	args = parser.parse_args()
+	random.seed(args.seed)
+
+	public = tempfile.mkdtemp(prefix='serve-react-bench-')
+	try:
+		bundles, media = make_public(public, args.bundles, args.bundle_size, args.media_size)
+		# what a page load looks like: mostly the page itself (at the root, or at one of ROUTES
+		# deep links that each come up about once), then its bundles, plus some seeking around in
+		# a video
+		scale = ROUTES // 50
+		requests = [('/', {})] * (20 * scale)
+		requests += [('/app/route/%d' % i, {}) for i in range(ROUTES)]
+		requests += [(path, {}) for path in bundles] * (5 * scale)
+		for i in range(5 * scale):
+			start = random.randrange(args.media_size - 65536)
+			requests.append((media, {'Range': 'bytes=%d-%d' % (start, start + 65535)}))
+
+		print("%d clients, %gs per scenario, %d x %dKB bundles, %dKB media" % (args.concurrency,
+			args.duration, args.bundles, args.bundle_size // 1024, args.media_size // 1024))
+		print("%-8s %-12s %9s %7s %9s %8s %8s %8s %8s %8s" % ('mode', 'scenario', 'requests',
+			'errors', 'req/s', 'MB/s', 'p50ms', 'p99ms', 'p999ms', 'rssMB'))
+		for mode in args.mode or ['dev', 'workers']:
+			for result in bench(mode, args, public, requests):
+				print("%(mode)-8s %(scenario)-12s %(requests)9d %(errors)7d %(rps)9.1f %(mbps)8.1f "
+					"%(p50)8.2f %(p99)8.2f %(p999)8.2f %(rss)8.1f" % result)
+				sys.stdout.flush()
+	finally:
+		shutil.rmtree(public)
@@ -1,13 +1,35 @@
 #!/usr/bin/python3
 
 import os
+import re
 import sys
+import gzip
+import time
+import queue
+import signal
+import socket
+import datetime
+import selectors
 import flask
+import werkzeug.http
+import werkzeug.wsgi
 import logging
+import mimetypes
+import threading
+import atexit
+import collections
+import urllib.parse
+import wsgiref.simple_server
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
 
 logging.basicConfig(level=logging.INFO)
 
-app = flask.Flask(__name__)
+# everything under the public path, /static/ included, is served from the AssetCache
+app = flask.Flask(__name__, static_folder=None)
 app.logger.setLevel(logging.INFO)
 
 logger = logging.getLogger('application')
@@ -16,7 +38,426 @@ logger.debug(os.environ)
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
-def configure_server(public_path):
+# build output with a content hash in its name (static/js/main.3f2a1b9c.chunk.js) never
+# changes; only the bundler's layout counts, and a run of digits is more likely a date
+# (report.20231015.pdf) than a hash, so isn't taken for one
+HASHED_ASSET = re.compile(r'^static/(?:[^/]+/)*[^/.]+\.(?=[0-9]*[a-f])[0-9a-f]{8,}(?:\.chunk)?\.[A-Za-z0-9]+(?:\.map)?$')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# worth compressing on the fly, if they're any size
+COMPRESSIBLE = re.compile(r'^(text/|application/(javascript|json|xml|manifest\+json)|image/svg\+xml)')
+MIN_COMPRESS = 1024
+# prebuilt siblings (main.js.br, main.js.gz), best first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+# bigger files than this are streamed from disk rather than kept in memory
+MAX_CACHED_SIZE = 2 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+BYTE_RANGE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+MAX_RANGES = 16
+
+def compress(contents, encoding):
+	if encoding == 'br':
+		return brotli.compress(contents, quality=9)
+	return gzip.compress(contents, 9, mtime=0)
+
+class FileBody(object):
+	""" a file that's sent straight from disk """
+	__slots__ = ('path', 'size')
+
+	def __init__(self, path, size):
+		self.path = path
+		self.size = size
+
+	def __len__(self):
+		return self.size
+
+	def open(self):
+		""" (file, size) with the size it has now, which the manifest's can be a scan behind on """
+		f = open(self.path, 'rb')
+		return f, os.fstat(f.fileno()).st_size
+
+def file_chunks(f, start, end):
+	f.seek(start)
+	while start < end:
+		chunk = f.read(min(CHUNK_SIZE, end - start))
+		if not chunk:
+			break
+		start += len(chunk)
+		yield chunk
+
+def read_body(path, size):
+	""" the contents of `path`, or a FileBody if it's too big to keep """
+	if size > MAX_CACHED_SIZE:
+		return FileBody(path, size)
+	with open(path, 'rb') as f:
+		return f.read()
+
+class Asset(object):
+	__slots__ = ('path', 'body', 'mime', 'etag', 'mtime', 'modified', 'size', 'hashed', 'signature',
+		'precompressed', 'compressible')
+
+	def __init__(self, path, body, mime, mtime, size, precompressed=None, signature=None):
+		self.path = path
+		self.body = body # bytes, or a FileBody for big files
+		self.mime = mime
+		self.etag = '%x-%x' % (int(mtime * 1000000), size)
+		self.mtime = mtime
+		# Last-Modified only goes to the second
+		self.modified = datetime.datetime.fromtimestamp(int(mtime), datetime.timezone.utc)
+		self.size = size
+		self.hashed = bool(HASHED_ASSET.search(path))
+		self.signature = signature # what the manifest said about it and its siblings when loaded
+		self.precompressed = precompressed or {} # encoding -> body
+		self.compressible = size >= MIN_COMPRESS and bool(COMPRESSIBLE.match(mime))
+
+class AssetCache(object):
+	"""
+	files under the public path, kept in memory along with their mime type, ETag and
+	Last-Modified. files over MAX_CACHED_SIZE only have their details kept, and are streamed from disk.
+
+	the public path is scanned once at startup into a manifest of url path -> file, then again
+	every `scan_interval` seconds by a watcher thread, which also throws away cached assets whose
+	files have changed. requests only ever look things up in memory: anything not in the manifest
+	(client side routes) is answered with the preloaded index.html without touching the disk.
+
+	assets are sent compressed when the client accepts it: from .br/.gz files next to them if
+	the build made some, otherwise, for those small enough to be kept in memory, compressed on
+	first request and kept, up to `max_compressed` bytes of it, least recently used going first.
+	files streamed from disk without siblings go out as they are.
+	"""
+	def __init__(self, root, scan_interval=2.0, max_compressed=64 * 1024 * 1024):
+		self.root = os.path.realpath(root)
+		self.scan_interval = scan_interval
+		self.files = {} # url path -> (file, mtime, size)
+		self.assets = {}
+		self.max_compressed = max_compressed
+		self.compressed = collections.OrderedDict() # (path, etag, encoding) -> contents or None
+		self.compressed_size = 0
+		self.lock = threading.Lock()
+
+	def start(self):
+		self.scan()
+		logger.info("serving %d files from %s", len(self.files), self.root)
+		self.start_watcher()
+		# forked workers share what's been loaded so far, but need a watcher of their own
+		os.register_at_fork(after_in_child=self.start_watcher)
+
+	def start_watcher(self):
+		watcher = threading.Thread(target=self.watch, name='asset-watcher')
+		watcher.daemon = True
+		watcher.start()
+
+	def watch(self):
+		while True:
+			time.sleep(self.scan_interval)
+			try:
+				self.scan()
+			except Exception:
+				logger.exception("couldn't scan %s", self.root)
+
+	def scan(self):
+		""" rebuild the manifest, forget assets that have changed, and (re)load index.html """
+		files = {}
+		for directory, _, filenames in os.walk(self.root):
+			for filename in filenames:
+				path = os.path.join(directory, filename)
+				try:
+					stat = os.stat(path)
+				except OSError:
+					continue
+				page = os.path.relpath(path, self.root).replace(os.sep, '/')
+				files[page] = (path, stat.st_mtime, stat.st_size)
+		self.files = files
+		for page, asset in list(self.assets.items()):
+			if asset.signature != self.signature(page):
+				self.assets.pop(page, None)
+		self.get('index.html')
+
+	def signature(self, page):
+		return tuple(self.files.get(page + extension) for extension in ('',) + tuple(e for _, e in ENCODINGS))
+
+	def get(self, page):
+		""" the Asset for `page`, or None if there's no such file """
+		asset = self.assets.get(page)
+		if asset is not None:
+			return asset
+		entry = self.files.get(page)
+		if entry is None:
+			return None
+		path, mtime, size = entry
+		mime, _ = mimetypes.guess_type(path)
+		try:
+			asset = Asset(page, read_body(path, size), mime or "text/html", mtime, size,
+				self.precompressed(page, mtime), self.signature(page))
+		except (IOError, OSError):
+			return None # gone since the last scan
+		self.assets[page] = asset
+		return asset
+
+	def precompressed(self, page, mtime):
+		""" {encoding: body} of the .br/.gz siblings of `page` that are at least as new as it """
+		found = {}
+		for encoding, extension in ENCODINGS:
+			entry = self.files.get(page + extension)
+			if entry is not None and entry[1] >= mtime:
+				found[encoding] = read_body(entry[0], entry[2])
+		return found
+
+	def encode(self, asset, accept):
+		""" (encoding, body) to send `asset` as, given the request's accept_encodings """
+		accepted = [encoding for encoding, _ in ENCODINGS if accept.quality(encoding)]
+		for encoding in accepted:
+			if encoding in asset.precompressed:
+				return encoding, asset.precompressed[encoding]
+		if asset.compressible and not isinstance(asset.body, FileBody):
+			for encoding in accepted:
+				if encoding == 'br' and brotli is None:
+					continue
+				body = self.compress(asset, encoding)
+				if body is not None:
+					return encoding, body
+		return None, asset.body
+
+	def compress(self, asset, encoding):
+		key = (asset.path, asset.etag, encoding)
+		with self.lock:
+			if key in self.compressed:
+				self.compressed.move_to_end(key)
+				return self.compressed[key]
+		contents = compress(asset.body, encoding)
+		if len(contents) >= asset.size:
+			contents = None # not worth it, remember that instead
+		size = len(contents or b'')
+		if size > self.max_compressed:
+			return contents
+		with self.lock:
+			old = self.compressed.pop(key, None)
+			self.compressed_size -= len(old or b'')
+			self.compressed[key] = contents
+			self.compressed_size += size
+			while self.compressed_size > self.max_compressed:
+				_, evicted = self.compressed.popitem(last=False)
+				self.compressed_size -= len(evicted or b'')
+		return contents
+
+def byte_ranges(header, size):
+	"""
+	the [(start, end)] a Range `header` asks for out of `size` bytes, dropping any that can't
+	be satisfied, or None if it should be ignored (not bytes, can't be parsed, or too many)
+	"""
+	unit, _, specs = header.partition('=')
+	if unit.strip() != 'bytes':
+		return None
+	specs = specs.split(',')
+	if len(specs) > MAX_RANGES:
+		return None
+	ranges = []
+	for spec in specs:
+		match = BYTE_RANGE.match(spec)
+		if not match or not (match.group(1) or match.group(2)):
+			return None
+		first, last = match.groups()
+		if first:
+			start = int(first)
+			end = min(int(last) + 1, size) if last else size
+		else:
+			start, end = max(size - int(last), 0), size
+		if start < end:
+			ranges.append((start, end))
+	return ranges
+
+def if_range_matches(header, etag, modified):
+	""" whether ranges can be sent given an If-Range `header`: it has to name what we'd send """
+	if not header:
+		return True
+	header = header.strip()
+	if header.startswith('"'):
+		return header == '"%s"' % etag
+	date = werkzeug.http.parse_date(header)
+	return date is not None and date == modified
+
+def body_chunks(body, start, end):
+	""" bytes `start` to `end` of `body`: bytes, or a file opened by FileBody.open() """
+	if isinstance(body, bytes):
+		return [body[start:end]]
+	return file_chunks(body, start, end)
+
+def closing(chunks, f):
+	""" `chunks`, then `f` closed (or when the client goes away) """
+	try:
+		for chunk in chunks:
+			yield chunk
+	finally:
+		if f is not None:
+			f.close()
+
+def asset_response(asset, encoding=None, body=None):
+	"""
+	a response for `asset`: 304 if the client's copy is current, the byte ranges it asked
+	for if any, otherwise the whole `body`, with files on disk going out through
+	wsgi.file_wrapper (sendfile, where the server has it)
+	"""
+	request = flask.request
+	if body is None:
+		body = asset.body
+	opened = None
+	if isinstance(body, FileBody):
+		# sizes in the response have to be the file's, not what the manifest last saw
+		body, size = opened = body.open()
+	else:
+		size = len(body)
+	# each encoding is its own representation, so needs its own ETag
+	etag = asset.etag + ('-' + encoding if encoding else '')
+	status = 200
+	ranges = None
+	if not werkzeug.http.is_resource_modified(request.environ, etag, last_modified=asset.modified):
+		status = 304
+	elif request.method in ('GET', 'HEAD') and request.headers.get('Range') and \
+			if_range_matches(request.headers.get('If-Range'), etag, asset.modified):
+		ranges = byte_ranges(request.headers['Range'], size)
+
+	if status == 304:
+		response = flask.Response(status=304)
+	elif ranges == []:
+		response = flask.Response(status=416)
+		response.headers['Content-Range'] = 'bytes */%d' % size
+	elif ranges and len(ranges) == 1:
+		start, end = ranges[0]
+		response = flask.Response(closing(body_chunks(body, start, end), opened and body), status=206, mimetype=asset.mime, direct_passthrough=True)
+		response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, size)
+		response.content_length = end - start
+	elif ranges:
+		boundary = '%x%x' % (int(time.time() * 1000000), id(ranges))
+		parts = []
+		length = 0
+		for start, end in ranges:
+			head = ('\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n'
+				% (boundary, asset.mime, start, end - 1, size)).encode('ascii')
+			parts.append((head, start, end))
+			length += len(head) + end - start
+		tail = ('\r\n--%s--\r\n' % boundary).encode('ascii')
+		def multipart():
+			for head, start, end in parts:
+				yield head
+				for chunk in body_chunks(body, start, end):
+					yield chunk
+			yield tail
+		multipart = closing(multipart(), opened and body)
+		response = flask.Response(multipart, status=206, direct_passthrough=True,
+			content_type='multipart/byteranges; boundary=' + boundary)
+		response.content_length = length + len(tail)
+	elif opened:
+		stream = werkzeug.wsgi.wrap_file(request.environ, body, CHUNK_SIZE)
+		response = flask.Response(stream, status=200, mimetype=asset.mime, direct_passthrough=True)
+		response.content_length = size
+	else:
+		response = flask.make_response(body, 200)
+	if opened:
+		# streamed bodies close it themselves once sent, this is for the responses without one
+		response.call_on_close(body.close)
+	if status == 200 and not ranges:
+		response.headers['Content-type'] = asset.mime
+	response.headers['Accept-Ranges'] = 'bytes'
+	if encoding and status != 304 and ranges != []:
+		response.headers['Content-Encoding'] = encoding
+	if asset.precompressed or asset.compressible:
+		response.vary.add('Accept-Encoding')
+	response.set_etag(etag)
+	response.last_modified = asset.modified
+	# hashed assets can be kept for good, everything else has to be revalidated (cheaply, with a 304)
+	response.headers['Cache-Control'] = IMMUTABLE if asset.hashed else 'no-cache'
+	return response
+
+class AccessLog(object):
+	"""
+	access log records are put on a bounded queue (or counted in `dropped` if it's full) and a
+	background thread formats and writes them in batches, so requests never wait on the log.
+	they go to `path` if given, which is reopened whenever it's been moved or deleted so log
+	rotation just works, or otherwise through the 'access' logger.
+	"""
+	def __init__(self, path=None, maxsize=10000, batch=500):
+		self.path = path
+		self.maxsize = maxsize
+		self.batch = batch
+		self.dropped = 0
+		self.file = None
+		self.inode = None
+		self.logger = logging.getLogger('access')
+		self.logger.setLevel(logging.INFO)
+		self.start()
+		# forked workers need a queue and writer of their own
+		os.register_at_fork(after_in_child=self.start)
+		atexit.register(self.close)
+
+	def start(self):
+		self.queue = queue.Queue(self.maxsize)
+		self.writer = threading.Thread(target=self.write_batches, name='access-log')
+		self.writer.daemon = True
+		self.writer.start()
+
+	def write(self, *record):
+		try:
+			self.queue.put_nowait(record)
+		except queue.Full:
+			self.dropped += 1
+
+	def format(self, record):
+		remote_addr, user, method, scheme, host, path, query, status, length = record
+		url = '%s://%s%s' % (scheme, host, urllib.parse.quote(path, safe="/;@&=+$,%!~*'()"))
+		if query:
+			url += '?' + query
+		return "\t".join([remote_addr, user, method, url, str(status), str(length)])
+
+	def write_batches(self):
+		while True:
+			records = [self.queue.get()]
+			try:
+				while len(records) < self.batch:
+					records.append(self.queue.get_nowait())
+			except queue.Empty:
+				pass
+			lines = []
+			for record in records:
+				try:
+					lines.append(self.format(record))
+				except Exception:
+					self.dropped += 1
+			try:
+				self.emit(lines)
+			except Exception:
+				self.dropped += len(lines)
+			for record in records:
+				self.queue.task_done()
+
+	def emit(self, lines):
+		if self.path is None:
+			for line in lines:
+				self.logger.info(line)
+			return
+		try:
+			inode = os.stat(self.path).st_ino
+		except OSError:
+			inode = None
+		if self.file is None or inode != self.inode:
+			if self.file is not None:
+				self.file.close()
+			self.file = open(self.path, 'a')
+			self.inode = os.fstat(self.file.fileno()).st_ino
+		self.file.write("".join(line + "\n" for line in lines))
+		self.file.flush()
+
+	def close(self, timeout=1):
+		""" give the writer a moment to catch up """
+		deadline = time.time() + timeout
+		while self.queue.unfinished_tasks and time.time() < deadline:
+			time.sleep(0.01)
+
+def configure_server(public_path, access_log_path=None):
+	assets = AssetCache(public_path)
+	assets.start()
+	access_log = app.extensions['access_log'] = AccessLog(access_log_path)
+
 	@app.errorhandler(Exception)
 	def handle_error(error):
 		# handle server faults (i.e. "non http" exceptions that get raised.
@@ -36,44 +477,388 @@ def configure_server(public_path):
 	def default(*args, **kwargs):
 		page = flask.request.path[1:]
 
-		try:
-			contents = open(os.path.join(public_path,page)).read()
-		except IOError as e:
-			logger.info("couldn't access %s on the file system, will try index.html instead", os.path.join(public_path,page))
-			try:
-				page = "index.html"
-				contents = open(os.path.join(public_path,page)).read()
-			except FileNotFoundError as e:
+		asset = assets.get(page)
+		if asset is None:
+			logger.debug("no %s in %s, will use index.html instead", page, public_path)
+			asset = assets.get("index.html")
+			if asset is None:
 				logger.error("couldn't find index.html")
 				return flask.make_response("<html><body>I couldn't find the file you asked for, and couldn't find index.html!</body></html>", 404)
 
-		import mimetypes
-		mime, _ = mimetypes.guess_type(page)
-
-		if not mime:
-			mime = "text/html"
- 
-		response = flask.make_response(contents, 200)
-		response.headers['Content-type'] = mime
-		return response
+		encoding, body = assets.encode(asset, flask.request.accept_encodings)
+		return asset_response(asset, encoding, body)
 
 	# log each request -- sadly we do it this way so that we are stil inside the request / response context.... otherwise we can't get the session data :-/
-	access_logger = logging.getLogger('access')
-	access_logger.setLevel(logging.INFO)
+	# only the raw fields are picked up here; AccessLog formats and writes them in the background
+	session_cookie = app.config.get('SESSION_COOKIE_NAME', 'session')
 	@app.after_request
 	def log_request(response):
-		access_logger.info("\t".join([flask.request.environ.get('REMOTE_ADDR', "no_ip"), flask.session.get('user',{}).get('email', '???'), flask.request.method, flask.request.url, str(response.status_code), str(response.content_length)]))
+		environ = flask.request.environ
+		user = '???'
+		# don't unpack a session that can't be there
+		if session_cookie in flask.request.cookies:
+			user = flask.session.get('user',{}).get('email', '???')
+		access_log.write(environ.get('REMOTE_ADDR', "no_ip"), user, environ['REQUEST_METHOD'],
+			environ['wsgi.url_scheme'], environ.get('HTTP_HOST') or environ.get('SERVER_NAME', ''),
+			environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''), environ.get('QUERY_STRING', ''),
+			response.status_code, response.content_length)
 
-		# Defeat IE's caching of XMLRPC calls
-		response.headers['Cache-Control'] = 'no-cache'
-		response.headers['Expires'] = '-1'
-		response.headers['Pragma'] = 'no-cache'
+		# Defeat IE's caching of XMLRPC calls (assets say for themselves how long they keep)
+		if 'Cache-Control' not in response.headers:
+			response.headers['Cache-Control'] = 'no-cache'
+			response.headers['Expires'] = '-1'
+			response.headers['Pragma'] = 'no-cache'
 
 		return response
 
-def run_server():
+class ServerHandler(wsgiref.simple_server.ServerHandler):
+	"""
+	wsgiref's, but speaking HTTP/1.1, keeping the connection open after any response whose
+	length is known, and sending wsgi.file_wrapper responses with sendfile
+	"""
+	http_version = '1.1'
+	keep_alive = False
+
+	def cleanup_headers(self):
+		super().cleanup_headers()
+		bodyless = self.status[:3] in ('204', '304') or self.environ['REQUEST_METHOD'] == 'HEAD'
+		self.keep_alive = (not self.request_handler.close_connection
+			and (bodyless or 'Content-Length' in self.headers)
+			and self.headers.get('Connection', '').lower() != 'close')
+		if not self.keep_alive:
+			self.headers['Connection'] = 'close'
+
+	def sendfile(self):
+		filelike = self.result.filelike
+		try:
+			offset = filelike.tell()
+			filelike.fileno()
+		except (AttributeError, OSError, ValueError):
+			return False
+		if not self.headers_sent:
+			self.send_headers()
+		self._flush()
+		# no more than Content-Length promised, whatever the file has done since the manifest
+		# was made; anything else would garble the next response on the connection
+		length = self.headers.get('Content-Length')
+		count = int(length) if length is not None else None
+		sent = self.request_handler.connection.sendfile(filelike, offset, count)
+		self.bytes_sent += sent
+		if count is not None and sent < count:
+			self.request_handler.close_connection = True
+		return True
+
+class KeepAliveHandler(wsgiref.simple_server.WSGIRequestHandler):
+	"""
+	handles requests on a connection for as long as they keep coming. when the client has
+	nothing more to say for now, the connection is `parked` with the server rather than
+	waited on, and `resume()`d on whichever thread is free once the next request arrives.
+	"""
+	protocol_version = 'HTTP/1.1'
+	timeout = 5 # seconds a request may take to arrive once it's started
+	parked = False
+
+	def handle(self):
+		self.parked = False
+		self.close_connection = True
+		self.handle_one_request()
+		while not self.close_connection:
+			if not self.buffered():
+				self.parked = True
+				return
+			self.handle_one_request()
+
+	def resume(self):
+		try:
+			self.handle()
+		finally:
+			self.finish()
+
+	def buffered(self):
+		""" whether the next request has already arrived, without waiting for it """
+		self.connection.settimeout(0)
+		try:
+			return bool(self.rfile.peek(1))
+		except OSError:
+			return True # let handle_one_request find out what's wrong
+		finally:
+			self.connection.settimeout(self.timeout)
+
+	def finish(self):
+		if not self.parked:
+			super().finish()
+
+	def handle_one_request(self):
+		try:
+			self.raw_requestline = self.rfile.readline(65537)
+		except (socket.timeout, ConnectionError):
+			self.close_connection = True
+			return
+		if not self.raw_requestline:
+			self.close_connection = True
+			return
+		if len(self.raw_requestline) > 65536:
+			self.requestline = self.request_version = self.command = ''
+			self.send_error(414)
+			return
+		if not self.parse_request():
+			return
+		# we don't know that the app will read a request body, so don't try to find the next request after one
+		if self.headers.get('Content-Length', '0') != '0' or 'Transfer-Encoding' in self.headers:
+			self.close_connection = True
+		handler = ServerHandler(self.rfile, self.wfile, self.get_stderr(), self.get_environ(), multithread=True)
+		handler.request_handler = self
+		handler.run(self.server.get_app())
+		if not handler.keep_alive:
+			self.close_connection = True
+
+	def log_request(self, *args, **kwargs):
+		pass # the access log has it
+
+class PoolServer(wsgiref.simple_server.WSGIServer):
+	"""
+	a WSGI server on an already listening socket `sock`, handing connections to a fixed pool of
+	`threads`. at most `backlog` connections wait for a thread; past that they get a 503 straight
+	away rather than queueing up behind everyone else.
+
+	threads are only handed connections with a request to read: new and kept-alive connections
+	are watched by the accept loop until the client sends something, and closed if it hasn't
+	after `keep_alive` seconds. idle clients cost a file descriptor each, not a thread.
+	"""
+	BUSY = b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nRetry-After: 1\r\nConnection: close\r\n\r\n"
+
+	def __init__(self, sock, app, threads=16, backlog=64, keep_alive=5):
+		handler = type('Handler', (KeepAliveHandler,), {'timeout': keep_alive})
+		wsgiref.simple_server.WSGIServer.__init__(self, sock.getsockname()[:2], handler, bind_and_activate=False)
+		self.socket.close()
+		self.socket = sock
+		self.server_name, self.server_port = sock.getsockname()[:2]
+		self.setup_environ()
+		self.set_app(app)
+		self.keep_alive = keep_alive
+		self.waiting = queue.Queue(backlog)
+		self.selector = selectors.DefaultSelector()
+		self.idle = collections.OrderedDict() # socket -> (client_address, handler or None, since), oldest first
+		self.parking = [] # (socket, client_address, handler) from pool threads, for the accept loop to watch
+		self.parking_lock = threading.Lock()
+		self.wake_reader, self.wake_writer = socket.socketpair()
+		self.wake_reader.setblocking(False)
+		self.stopping = False
+		self.stopped = threading.Event()
+		self.threads = [threading.Thread(target=self.work, name='http-%d' % i) for i in range(threads)]
+		for thread in self.threads:
+			thread.daemon = True
+			thread.start()
+
+	def get_request(self):
+		request, client_address = self.socket.accept()
+		# headers and body go out in separate writes; don't let the body sit waiting for an ACK
+		request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		return request, client_address
+
+	def process_request(self, request, client_address):
+		self.watch(request, client_address, None)
+
+	def serve_forever(self, poll_interval=0.5):
+		self.selector.register(self.socket, selectors.EVENT_READ)
+		self.selector.register(self.wake_reader, selectors.EVENT_READ)
+		try:
+			while not self.stopping:
+				for key, _ in self.selector.select(poll_interval):
+					if key.fileobj is self.socket:
+						self._handle_request_noblock()
+					elif key.fileobj is self.wake_reader:
+						self.take_parked()
+					else:
+						self.ready(key.fileobj)
+				self.expire(time.time() - self.keep_alive)
+		finally:
+			self.selector.unregister(self.socket)
+			with self.parking_lock:
+				self.stopping = True
+			self.take_parked()
+			self.expire(float('inf'))
+			self.stopped.set()
+
+	def shutdown(self):
+		self.stopping = True
+		self.wake_writer.send(b'x')
+		self.stopped.wait()
+
+	def watch(self, request, client_address, handler):
+		""" wait in the accept loop for the client's next request """
+		self.selector.register(request, selectors.EVENT_READ)
+		self.idle[request] = (client_address, handler, time.time())
+
+	def park(self, request, client_address, handler):
+		""" hand a kept-alive connection back to the accept loop; False if it should just be closed """
+		with self.parking_lock:
+			# checked under the lock, so serve_forever's last take_parked() sees anything let in
+			if self.stopping:
+				return False
+			self.parking.append((request, client_address, handler))
+		self.wake_writer.send(b'x')
+		return True
+
+	def take_parked(self):
+		try:
+			while self.wake_reader.recv(4096):
+				pass
+		except BlockingIOError:
+			pass
+		with self.parking_lock:
+			parking, self.parking = self.parking, []
+		for request, client_address, handler in parking:
+			self.watch(request, client_address, handler)
+
+	def ready(self, request):
+		""" `request` has something to read, so give it to a thread """
+		self.selector.unregister(request)
+		client_address, handler, since = self.idle.pop(request)
+		try:
+			self.waiting.put_nowait((request, client_address, handler))
+		except queue.Full:
+			try:
+				request.sendall(self.BUSY)
+			except OSError:
+				pass
+			self.close(request, handler)
+
+	def expire(self, before):
+		""" close connections that have been idle since `before` """
+		while self.idle:
+			request, (client_address, handler, since) = next(iter(self.idle.items()))
+			if since > before:
+				break
+			self.selector.unregister(request)
+			del self.idle[request]
+			self.close(request, handler)
+
+	def close(self, request, handler):
+		if handler is not None and handler.parked:
+			handler.parked = False
+			handler.finish()
+		self.shutdown_request(request)
+
+	def work(self):
+		while True:
+			item = self.waiting.get()
+			if item is None:
+				return
+			request, client_address, handler = item
+			parked = False
+			try:
+				if handler is None:
+					handler = self.RequestHandlerClass(request, client_address, self)
+				else:
+					handler.resume()
+				parked = handler.parked and self.park(request, client_address, handler)
+			except Exception:
+				self.handle_error(request, client_address)
+			finally:
+				if not parked:
+					self.close(request, handler)
+
+	def drain(self, timeout):
+		""" finish the connections already accepted, giving up after `timeout` seconds """
+		for thread in self.threads:
+			self.waiting.put(None)
+		deadline = time.time() + timeout
+		for thread in self.threads:
+			thread.join(max(deadline - time.time(), 0))
+
+class Supervisor(object):
+	"""
+	runs `workers` copies of `serve_worker()` in child processes, all accepting on the same
+	listening socket. workers that die are started again. SIGHUP restarts them gracefully: a
+	new set is started first, then the old ones stop accepting, finish what they have and exit.
+	SIGTERM or ^C stops them all the same way (workers ignore SIGINT, so a ^C in the terminal
+	reaches them only as the SIGTERM from here).
+	"""
+	restart_delay = 1
+
+	def __init__(self, workers, serve_worker):
+		self.workers = workers
+		self.serve_worker = serve_worker
+		self.children = {} # pid -> generation
+		self.generation = 0
+		self.stopping = False
+
+	def spawn(self):
+		pid = os.fork()
+		if pid == 0:
+			for signum in (signal.SIGHUP, signal.SIGTERM):
+				signal.signal(signum, signal.SIG_DFL)
+			signal.signal(signal.SIGINT, signal.SIG_IGN)
+			status = 1
+			try:
+				self.serve_worker()
+				status = 0
+			except Exception:
+				logger.exception("worker %d died", os.getpid())
+			finally:
+				os._exit(status)
+		self.children[pid] = self.generation
+
+	def restart(self, signum=None, frame=None):
+		old = list(self.children)
+		self.generation += 1
+		logger.info("restarting %d workers", self.workers)
+		for i in range(self.workers):
+			self.spawn()
+		self.signal(old, signal.SIGTERM)
+
+	def stop(self, signum=None, frame=None):
+		self.stopping = True
+		self.signal(list(self.children), signal.SIGTERM)
+
+	def signal(self, pids, signum):
+		for pid in pids:
+			try:
+				os.kill(pid, signum)
+			except OSError:
+				pass
+
+	def run(self):
+		signal.signal(signal.SIGHUP, self.restart)
+		signal.signal(signal.SIGTERM, self.stop)
+		signal.signal(signal.SIGINT, self.stop)
+		for i in range(self.workers):
+			self.spawn()
+		while self.children:
+			try:
+				pid, status = os.wait()
+			except ChildProcessError:
+				break
+			generation = self.children.pop(pid, None)
+			if generation != self.generation or self.stopping:
+				continue
+			logger.warning("worker %d exited with status %d, restarting", pid, status)
+			time.sleep(self.restart_delay)
+			if not self.stopping:
+				self.spawn()
+
+def listen(host, port, backlog):
+	sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	sock.bind((host, port))
+	sock.listen(backlog)
+	# every worker waits on it, and the ones that lose the race for a connection mustn't block
+	sock.setblocking(False)
+	return sock
+
+def serve_worker(sock, threads, backlog, keep_alive, graceful_timeout=30):
+	server = PoolServer(sock, app, threads, backlog, keep_alive)
+	# shutdown() waits for serve_forever() to notice, so can't be called from inside it
+	signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+	server.serve_forever()
+	server.drain(graceful_timeout)
+	if 'access_log' in app.extensions:
+		app.extensions['access_log'].close()
+
+def run_server(port=5000, workers=0, threads=16, backlog=64, keep_alive=5):
 	try:
-		import pyqrcode, socket
+		import pyqrcode
 		# via https://stackoverflow.com/questions/166506/finding-local-ip-addresses-using-pythons-stdlib
 		s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 		ip = "127.0.0.1"
@@ -84,18 +869,36 @@ def run_server():
 		finally:
 			s.close()
 
-		url = 'http://'+ip+":5000"
+		url = 'http://'+ip+":"+str(port)
 		qr = pyqrcode.create(url)
 		print(qr.terminal(quiet_zone=1))
 		logger.info("external address: "+ url)
 	except Exception as e:
 		logger.info("qrcode not installed, not showing QR", e)
 
-	app.run(host=app.config.get('LISTEN_HOST', '0.0.0.0'), threaded=True)
+	host = app.config.get('LISTEN_HOST', '0.0.0.0')
+	if not workers:
+		app.run(host=host, port=port, threaded=True)
+		return
+
+	sock = listen(host, port, workers * backlog)
+	logger.info("listening on %s:%d with %d workers of %d threads", host, port, workers, threads)
+	Supervisor(workers, lambda: serve_worker(sock, threads, backlog, keep_alive)).run()
 
 if __name__ == '__main__':
-	path = './'
-	if len(sys.argv) > 1:
-		path = sys.argv[1]
-	configure_server(path)
-	run_server()
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument('path', nargs='?', default='./', help="the directory to serve (default: %(default)s)")
+	parser.add_argument('--port', type=int, default=5000, help="port to listen on (default: %(default)s)")
+	parser.add_argument('--workers', type=int, default=0,
+		help="worker processes to serve with; 0 runs flask's development server (default: %(default)s)")
+	parser.add_argument('--threads', type=int, default=16, help="threads per worker (default: %(default)s)")
+	parser.add_argument('--backlog', type=int, default=64,
+		help="connections that may wait for a thread, per worker, before getting a 503 (default: %(default)s)")
+	parser.add_argument('--keep-alive', type=float, default=5,
+		help="seconds an idle keep-alive connection is held open (default: %(default)s)")
+	parser.add_argument('--access-log', metavar='PATH',
+		help="file to write the access log to, reopened when it's rotated (default: the 'access' logger)")
+	args = parser.parse_args()
+	configure_server(args.path, args.access_log)
+	run_server(args.port, args.workers, args.threads, args.backlog, args.keep_alive)
@@ -6,13 +6,85 @@
 
 # E.g. ./table_exporter_mysql.py localhost 3306 wordpress_db root wibble_password 'select * from posts'
 
+# For tables too big to hold in memory, --stream reads the rows off the server as they are
+# written out (an unbuffered SSCursor) instead of fetching the whole result first. The
+# connection can't be used for anything else until the last row is read, and a slow
+# reader holds the query open on the server for as long as the export takes:
+# ./table_exporter_mysql.py --stream localhost 3306 wordpress_db root wibble_password 'select * from posts' > posts.csv
+
+import os
 import csv
 import sys
+import binascii
 import MySQLdb
+import MySQLdb.cursors
+from MySQLdb.constants import FIELD_TYPE, FLAG
+
+# these can hold bytes (BLOB, BINARY, VARBINARY) as well as text
+BYTES_TYPES = (FIELD_TYPE.TINY_BLOB, FIELD_TYPE.MEDIUM_BLOB, FIELD_TYPE.LONG_BLOB, FIELD_TYPE.BLOB,
+	FIELD_TYPE.STRING, FIELD_TYPE.VAR_STRING)
+
+def format_time(value):
+	""" TIME columns come back as timedeltas, write them the way MySQL does (-838:59:59) """
+	total = (value.days * 86400 + value.seconds) * 1000000 + value.microseconds
+	sign = '-' if total < 0 else ''
+	seconds, microseconds = divmod(abs(total), 1000000)
+	text = '%s%02d:%02d:%02d' % (sign, seconds // 3600, seconds // 60 % 60, seconds % 60)
+	if microseconds:
+		text += '.%06d' % microseconds
+	return text
+
+def format_bit(value):
+	""" BIT columns come back as big-endian bytes """
+	return int(binascii.hexlify(value), 16)
+
+def hex_binary(value):
+	""" Bytes in hex if they have a NUL in them, which csv can't hold """
+	if '\x00' in value:
+		return binascii.hexlify(value)
+	return value
+
+def column_converter(type_code, flags):
+	"""
+	Function to turn a column's values into something csv.writer can write, or None if it
+	can write them as they are: it already writes ints, decimals, floats and datetimes
+	itself, and text arrives as UTF-8 bytes. Binary strings and blobs with NUL bytes in are
+	written in hex, since csv can't hold those. MySQLdb doesn't tell us a column's character
+	set (63 is binary), and the BINARY flag is set on _bin collated text too, so the flag
+	only says which columns to look at, the values say whether they're text.
+	"""
+	if type_code == FIELD_TYPE.TIME:
+		return format_time
+	if type_code == FIELD_TYPE.BIT:
+		return format_bit
+	if type_code in BYTES_TYPES and flags & FLAG.BINARY:
+		return hex_binary
+	return None
+
+def row_converter(description, flags):
+	""" Function converting whole rows for csv.writer, or None if they can be written as they are """
+	converters = [(i, converter) for i, converter in enumerate(
+		column_converter(field[1], field_flags) for field, field_flags in zip(description, flags))
+		if converter is not None]
+	if not converters:
+		return None
+	def convert(row):
+		row = list(row)
+		for i, converter in converters:
+			if row[i] is not None:
+				row[i] = converter(row[i])
+		return row
+	return convert
 
 if __name__ == '__main__':
 	from optparse import OptionParser, OptionGroup
 	parser = OptionParser('%prog [options] HOST PORT MYSQLDB MYSQLUSERNAME MYSQLPASSWORD QUERY')
+	parser.add_option('--stream', action='store_true', default=False,
+		help='stream rows from the server instead of loading the whole result into memory first')
+	parser.add_option('--batch-size', type='int', default=1000,
+		help='rows fetched and written at a time [%default]')
+	parser.add_option('--charset', default='utf8mb4',
+		help='character set text is fetched and written in [%default]')
 	options, args = parser.parse_args()
 
 	if len(args) < 5:
@@ -28,19 +100,26 @@ if __name__ == '__main__':
 	password = args[4]
 	query = args[5]
 
-	csv_writer = csv.writer(sys.stdout)
+	output = os.fdopen(os.dup(sys.stdout.fileno()), 'wb', 1 << 20)
+	csv_writer = csv.writer(output)
 
-	connection = MySQLdb.connect (host = host, port = port, user = username, passwd = password, db = mysqldb)
+	connection = MySQLdb.connect (host = host, port = port, user = username, passwd = password, db = mysqldb,
+		charset = options.charset, use_unicode = False)
 
-	cursor = connection.cursor()
+	if options.stream:
+		cursor = connection.cursor(MySQLdb.cursors.SSCursor)
+	else:
+		cursor = connection.cursor()
 	cursor.execute(query)
 
 	fields = cursor.description
 	csv_writer.writerow([f[0] for f in cursor.description])
-	row = cursor.fetchone()
-	while row:
-		csv_writer.writerow([unicode(str(r), encoding="ascii", errors='ignore') for r in row])
-		row = cursor.fetchone()
+	convert = row_converter(cursor.description, cursor.description_flags)
+	rows = cursor.fetchmany(options.batch_size)
+	while rows:
+		csv_writer.writerows(map(convert, rows) if convert else rows)
+		rows = cursor.fetchmany(options.batch_size)
 	cursor.close()
 	connection.close()
+	output.close()
 
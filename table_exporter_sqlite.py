@@ -18,6 +18,22 @@
 import csv
 import sys
 import sqlite3
+import binascii
+import itertools
+
+def hex_blob(value):
+	""" Blobs in hex, since csv can't hold NUL bytes """
+	if isinstance(value, buffer):
+		return binascii.hexlify(value)
+	return value
+
+def convert_row(row):
+	"""
+	A row as csv.writer should see it. It writes numbers and text (UTF-8 bytes, with
+	text_factory = str) itself, only blobs need converting; SQLite doesn't say what
+	type a column is, and any column can hold a blob, so every value gets looked at.
+	"""
+	return map(hex_blob, row)
 
 if __name__ == '__main__':
 	from optparse import OptionParser, OptionGroup
@@ -43,7 +59,6 @@ if __name__ == '__main__':
 
 	fields = cursor.description
 	csv_writer.writerow([f[0] for f in cursor.description])
-	for row in cursor:
-		csv_writer.writerow([unicode(str(r), encoding="ascii", errors='ignore') for r in row])
+	csv_writer.writerows(itertools.imap(convert_row, cursor))
 	cursor.close()
 